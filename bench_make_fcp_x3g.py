@@ -0,0 +1,288 @@
+"""
+Benchmarks the stages of make_fcp_x3g.py on synthetic FlashForge Creator Pro
+G-code of configurable size, and reports throughput and peak memory as JSON.
+
+Every stage runs in a fresh process on a fresh copy of the generated file, so
+the peak RSS of one stage is not polluted by another. External programs (GPX
+and the post-processing scripts) are replaced by stubs that merely copy their
+input, such that only the overhead of invoking them is measured.
+"""
+import argparse
+import concurrent.futures
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import make_fcp_x3g as mfx  # noqa: E402
+
+
+STAGES = ('keep_orig', 'adjust_final_z', 'detection', 'detection_stream', 'check_moves', 'check_moves_parallel', 'estimate', 'estimate_parallel', 'rewrite', 'script', 'gpx', 'total')
+
+STUB_GPX = '''#!{python}
+import shutil, sys
+args = [a for a in sys.argv[1:] if a != '-p']
+shutil.copyfile(args[-2], args[-1])
+'''
+
+STUB_SCRIPT = '''#!{python}
+import shutil, sys
+if '-h' in sys.argv:
+    sys.exit(0)
+args = sys.argv[1:]
+shutil.copyfile(args[-1], args[args.index('-o') + 1])
+'''
+
+
+def generate_gcode(path, moves, dual=False, m104=True, m83=True, final_z=True, seed=1, z_hops=False):
+    """
+    Writes FFCP G-code in the style of PrusaSlicer with the given number of G1
+    moves, spread over layers of 0.2mm. With z_hops, every few layers the
+    nozzle is lifted in relative positioning for the rest of the layer.
+    Returns the size of the file.
+    """
+    rnd = random.Random(seed)
+    moves_per_layer = 2000
+    with open(path, 'w') as o_handle:
+        o_handle.write('; generated by bench_make_fcp_x3g.py\n')
+        if m104:
+            o_handle.write('M104 S210 T0; set temperature\n')
+            if dual:
+                o_handle.write('M104 S215 T1; set temperature\n')
+        o_handle.write('M140 S60 ; set bed temperature\n')
+        o_handle.write(f";- - - Custom G-code for {'dual' if dual else 'left'} extruder printing\n")
+        o_handle.write('G28\nG90 ; use absolute coordinates\n')
+        if m83:
+            o_handle.write('M83 ; use relative distances for extrusion\n')
+        o_handle.write('M73 P1 ;@body\n')
+
+        z = 0.0
+        x = y = 0.0
+        lines = []
+        for n in range(moves):
+            if n % moves_per_layer == 0:
+                z += 0.2
+                lines.append(f';LAYER_CHANGE\n;Z:{z:.1f}\nG1 Z{z:.3f} F7800.000\n')
+                if z_hops and n % (moves_per_layer * 3) == 0:
+                    lines.append(f'G91\nG1 Z{rnd.uniform(0.2, 1):.3f} F600\nG1 X{rnd.uniform(-2, 2):.3f}\nG90\n')
+                if dual and n % (moves_per_layer * 4) == 0:
+                    lines.append(f"T{(n // (moves_per_layer * 4)) % 2}\n")
+            x = max(-100.0, min(100.0, x + rnd.uniform(-5, 5)))
+            y = max(-70.0, min(70.0, y + rnd.uniform(-5, 5)))
+            if n % 10 == 0:
+                lines.append(f'G1 X{x:.3f} Y{y:.3f} F9000.000\n')
+            else:
+                lines.append(f'G1 X{x:.3f} Y{y:.3f} E{rnd.uniform(0.01, 0.2):.5f}\n')
+            if len(lines) >= 10000:
+                o_handle.writelines(lines)
+                lines = []
+        o_handle.writelines(lines)
+
+        o_handle.write('M107\nM104 S0 T0\nM140 S0\n')
+        if final_z:
+            o_handle.write(f'G1 Z{min(z, 150) / 2:.1f} F1000 {mfx.Config.FINAL_Z_MOVE}\n')
+        o_handle.write('M18\n')
+    return os.path.getsize(path)
+
+
+def write_stub(path, template):
+    with open(path, 'w') as o_handle:
+        o_handle.write(template.format(python=sys.executable))
+    os.chmod(path, 0o755)
+
+
+def parallel_ranges(path):
+    """Splits the file at path for all CPU cores, regardless of PARALLEL_SCAN_SIZE."""
+    with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return mfx.split_ranges(buf, os.cpu_count() or 1)
+
+
+def verify_parallel(path, count):
+    """
+    Checks and estimates the file at path in count ranges, like on count CPU
+    cores, and returns a list of the ways in which the merged results differ
+    from checking and estimating it in one go.
+    """
+    config = mfx.Config()
+    serial = mfx.MotionCheck(config)
+    with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        serial.feed(buf)
+        ranges = mfx.split_ranges(buf, count)
+    merged = mfx.MotionCheck(config)
+    for start, end in ranges:
+        merged.merge(mfx.check_range(path, start, end, config))
+    with open(path, 'rb') as i_handle:
+        total, layers = mfx.estimate_print_time(i_handle)
+    merged_total, merged_layers = 0.0, []
+    for start, end in ranges:
+        part_total, part_layers = mfx.estimate_range(path, start, end)
+        merged_layers += [(offset, line, merged_total + elapsed) for offset, line, elapsed in part_layers]
+        merged_total += part_total
+
+    differences = []
+    if merged.warnings() != serial.warnings():
+        differences.append(f"check_moves: {merged.warnings()} instead of {serial.warnings()}")
+    if not math.isclose(merged_total, total, rel_tol=1e-9) or len(merged_layers) != len(layers):
+        differences.append(f"estimate: {merged_total}s and {len(merged_layers)} layers instead of {total}s and {len(layers)}")
+    elif any(not math.isclose(a[2], b[2], rel_tol=1e-9, abs_tol=1e-9) or a[0] != b[0] for a, b in zip(merged_layers, layers)):
+        differences.append("estimate: the elapsed time at some layer changes differs")
+    return differences
+
+
+def run_stage(stage, path, work_dir):
+    """Runs a single stage inside a fresh worker process, and measures it."""
+    config = mfx.Config(GPX=os.path.join(work_dir, 'gpx'))
+    job = mfx.Job(path, config, mfx.Options(quiet=True))
+
+    ctx = mfx.new_context()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    if stage == 'keep_orig':
+        mfx.backup_file(path, job.origfile)
+    elif stage == 'adjust_final_z':
+        mfx.adjust_final_z(job, path)
+    elif stage == 'detection':
+        mfx.scan_markers(path)
+    elif stage == 'detection_stream':
+        with open(path, 'rb') as i_handle:
+            for _ in mfx.detect_markers(i_handle, ctx):
+                pass
+    elif stage == 'check_moves':
+        mfx.check_file_moves(job, path)
+    elif stage == 'check_moves_parallel':
+        mfx.check_file_moves(job, path, parallel_ranges(path))
+    elif stage == 'estimate':
+        with open(path, 'rb') as i_handle:
+            mfx.estimate_print_time(i_handle)
+    elif stage == 'estimate_parallel':
+        mfx.estimate_progress(job, path, mfx.new_context(), parallel_ranges(path))
+    elif stage == 'rewrite':
+        ctx.update(mfx.scan_markers(path), scanned=True)
+        mfx.process_gcode(path, [mfx.fix_m104, mfx.inject_m83], ctx)
+    elif stage == 'script':
+        mfx.run_script(job, 'benchmark', path, [os.path.join(work_dir, 'script')])
+    elif stage == 'gpx':
+        mfx.run_gpx(job, path, job.x3g_file, '-p')
+    elif stage == 'total':
+        job.run()
+    result = {
+        'seconds': time.perf_counter() - start,
+        'cpu_seconds': time.process_time() - cpu_start,
+    }
+    if resource:
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+        scale = 1024 if sys.platform == 'darwin' else 1
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+        result['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    return result
+
+
+def benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='bench_make_fcp_x3g_')
+    try:
+        source = os.path.join(work_dir, 'source.gcode')
+        size = generate_gcode(source, args.moves, dual=args.dual, m104=not args.no_m104,
+                              m83=not args.no_m83, final_z=not args.no_final_z, seed=args.seed,
+                              z_hops=args.z_hops)
+        if args.verify:
+            differences = verify_parallel(source, max(4, os.cpu_count() or 1))
+            if differences:
+                print("Parallel scan differs from serial scan:\n" + '\n'.join(differences), file=sys.stderr)
+                sys.exit(1)
+        write_stub(os.path.join(work_dir, 'gpx'), STUB_GPX)
+        write_stub(os.path.join(work_dir, 'script'), STUB_SCRIPT)
+
+        report = {
+            'version': mfx.VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'moves': args.moves,
+            'dual': args.dual,
+            'size_bytes': size,
+            'repeat': args.repeat,
+            'stages': {},
+        }
+        # Spawn rather than fork, such that every stage starts from a clean
+        # interpreter and its peak RSS means something.
+        context = multiprocessing.get_context('spawn')
+        for stage in args.stages:
+            runs = []
+            for _ in range(args.repeat):
+                path = os.path.join(work_dir, 'input.gcode')
+                shutil.copyfile(source, path)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    runs.append(pool.submit(run_stage, stage, path, work_dir).result())
+            best = min(runs, key=lambda run: run['seconds'])
+            best['mb_per_s'] = size / 1048576 / best['seconds'] if best['seconds'] else None
+            report['stages'][stage] = best
+            if not args.quiet:
+                print(f"{stage:18} {best['seconds']:8.3f}s {best['mb_per_s'] or 0:9.1f} MB/s"
+                      + (f"  peak RSS {best['peak_rss_kb'] / 1024:.1f} MB" if 'peak_rss_kb' in best else ''),
+                      file=sys.stderr)
+        return report
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(report, baseline, tolerance):
+    """Returns a list of stages that got slower than baseline by more than tolerance percent."""
+    regressions = []
+    for stage, result in report['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if not old or not old.get('seconds'):
+            continue
+        change = (result['seconds'] / old['seconds'] - 1) * 100
+        if change > tolerance:
+            regressions.append(f"{stage}: {old['seconds']:.3f}s -> {result['seconds']:.3f}s (+{change:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of make_fcp_x3g.py on synthetic FFCP G-code, and writes the results as JSON.")
+    parser.add_argument('-n', '--moves', type=int, default=1000000, help='Number of G1 moves in the generated file (default: 1000000).')
+    parser.add_argument('--dual', action='store_true', help='Generate a dual extrusion file instead of a single extrusion one.')
+    parser.add_argument('--no-m104', action='store_true', help='Omit the M104 commands with T argument.')
+    parser.add_argument('--no-m83', action='store_true', help='Omit M83, i.e. use absolute extrusion.')
+    parser.add_argument('--no-final-z', action='store_true', help='Omit the FINAL_Z_MOVE line from the end G-code.')
+    parser.add_argument('--z-hops', action='store_true', help='Lift the nozzle in relative positioning (G91) every few layers.')
+    parser.add_argument('--verify', action='store_true', help='Before benchmarking, check that scanning the generated file in parallel gives the same results as scanning it in one go. Exits with status 1 if not.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the generated moves.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Run every stage this many times and keep the fastest (default: 3).')
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=list(STAGES), help='Stages to benchmark (default: all).')
+    parser.add_argument('-o', '--output', type=str, help='Write the JSON report to this file instead of stdout.')
+    parser.add_argument('-c', '--compare', type=str, help='JSON report of an earlier run. Exits with status 1 if any stage got slower by more than the tolerance.')
+    parser.add_argument('-t', '--tolerance', type=float, default=10, help='Allowed slowdown in percent when comparing (default: 10).')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print a summary to stderr.')
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as o_handle:
+            json.dump(report, o_handle, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as i_handle:
+            regressions = compare(report, json.load(i_handle), args.tolerance)
+        if regressions:
+            print("Regressions found:\n" + '\n'.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
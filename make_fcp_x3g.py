@@ -1,87 +1,181 @@
+"""
+Processes G-code files for the FlashForge Creator Pro, and optionally converts
+them to X3G using GPX.
+
+Besides being a command line script, this can be imported as a library, such
+that a long-lived process can run the pipeline without paying for interpreter
+startup and configuration parsing on every file:
+
+    config = make_fcp_x3g.read_config('make_fcp_x3g.txt')
+    job = make_fcp_x3g.process('print.gcode', config, make_fcp_x3g.Options(keep_orig=True))
+
+process() raises ProcessingError when a file cannot be processed. The built-in
+transforms are also available on streams of G-code through transform_lines()
+and transform_bytes().
+"""
 import subprocess
 import os
 import sys
 import time
 import argparse
+import bisect
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import math
+import mmap
 import re
+import select
+import shutil
+import signal
+import struct
 import tempfile
+import threading
+import zlib
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
 
 VERSION = '20211215'
 
-# Defaults. Each variable will be overridden if specified in the config file.
-# If an array is specified in the file for a SINGLE-value item, only the first
-# element of the array will be considered.
-# In theory the script could be run without a config file at all, but I don't
-# allow this because it would hide configuration mistakes.
-
-EXTRA_PATH = ''
-keep_orig = 0
-debug = 0
-
-GPX = ''
+DEFAULT_CONF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'make_fcp_x3g.txt')
 
-DUALSTRUDE_SCRIPT = []
-PWM_SCRIPT = []
-RETRACT_SCRIPT = []
 
-Z_MAX = 150
-FINAL_Z_MOVE = '; send Z axis to bottom of machine'
-MACHINE = 'r1d'
+class ProcessingError(Exception):
+    """
+    Raised when a file cannot be processed. code is the exit status of the
+    command line script in that case.
+    """
 
-conf_file = os.path.join(os.path.dirname(sys.argv[0]), 'make_fcp_x3g.txt')
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
 
-parser = argparse.ArgumentParser(description="Processes G-code file for the FFCP and optionally converts it to X3G using GPX. Input file is overwritten and the X3G file is placed next to it, unless the SLIC3R_PP_OUTPUT_NAME environment variable exists. In the latter case, all additional files will be created based on the path indicated by that variable.")
-parser.add_argument('-f', type=str, default=conf_file, help="Use custom config file. By default, the script looks for a file 'make_fcp_x3g.txt' in the same directory as the script. A config file is mandatory (it may be empty though).")
-parser.add_argument('-c', action='store_true', help='Performs a sanity check on all configured paths, and warns if they do not point to executable files. (Nothing will be processed even if other arguments are passed.)')
-parser.add_argument('-d', action='store_true', help="Debug mode: performs the sanity check, writes its result to a file 'make_fcp_x3g_check.txt' in the same directory as the input, and then continues processing. Will try to write a FAIL file in all cases where the script aborts unexpectedly.")
-parser.add_argument('-w', action='store_true', help='Converts Windows file path to a Linux path inside a WSL environment.')
-parser.add_argument('-P', action='store_true', help='Disables all postprocessing and only runs GPX without -p option.')
-parser.add_argument('-p', action='store_true', help='Enable -p option of GPX even if -P is used.')
-parser.add_argument('-k', action='store_true', help='Keep copy of original file.')
-parser.add_argument('-s', type=int, help='Pause S seconds when exiting, useful for troubleshooting in Windows.')
-parser.add_argument('-v', action='store_true', help='Verbose output.')
-parser.add_argument('inputfile', type=str, help='Input file to be processed.')
 
-args = parser.parse_args()
+class Config:
+    """
+    Settings from a configuration file, see read_config. Attributes are named
+    after the configuration items. Items not in the file keep their defaults.
+    """
 
-conf_file = args.f
-sanity = args.c
-wsl = args.w
-no_postproc = args.P
-force_progress = args.p
-exit_sleep = args.s
-verbose = args.v
-debug = 1 if args.d else 0
+    # Defaults. Each variable will be overridden if specified in the config file.
+    # If an array is specified in the file for a SINGLE-value item, only the first
+    # element of the array will be considered.
+    # The command line script refuses to run without a config file, because that
+    # would hide configuration mistakes. A Config() without a file is fine for
+    # callers that set the items themselves.
+    KEEP_ORIG = 0
+    DEBUG = 0
+    EXTRA_PATH = ''
+
+    GPX = ''
+
+    X_MAX = 114
+    Y_MAX = 75
+    Z_MAX = 150
+    FIRST_LAYER_MAX = 0.4
+    FINAL_Z_MOVE = '; send Z axis to bottom of machine'
+    MACHINE = 'r1d'
+
+    CACHE_DIR = ''
+    CACHE_SIZE = 1024
+
+    PIPE_SCRIPTS = 0
+    FSYNC = 0
+    COMPRESS = 0
+    ESTIMATE_PROGRESS = 0
+    PARALLEL_SCAN_SIZE = 32
+    GPX_JOBS = 1
+
+    WATCH_DIR = ''
+
+    SINGLE = ('KEEP_ORIG', 'DEBUG', 'EXTRA_PATH', 'GPX', 'X_MAX', 'Y_MAX', 'Z_MAX', 'FIRST_LAYER_MAX', 'FINAL_Z_MOVE',
+              'MACHINE', 'CACHE_DIR', 'CACHE_SIZE', 'PIPE_SCRIPTS', 'FSYNC', 'COMPRESS', 'ESTIMATE_PROGRESS',
+              'PARALLEL_SCAN_SIZE', 'GPX_JOBS', 'WATCH_DIR')
+    MULTIPLE = ('DUALSTRUDE_SCRIPT', 'PWM_SCRIPT', 'RETRACT_SCRIPT')
+
+    def __init__(self, path=None, **items):
+        self.path = path
+        # Suspect things found while reading the file.
+        self.warnings = []
+        self.DUALSTRUDE_SCRIPT = []
+        self.PWM_SCRIPT = []
+        self.RETRACT_SCRIPT = []
+        for item, value in items.items():
+            if item not in self.SINGLE and item not in self.MULTIPLE:
+                raise TypeError(f"unknown configuration item '{item}'")
+            setattr(self, item, value)
+
+
+class Options:
+    """
+    Options for processing files, the equivalents of the command line arguments.
+    keep_orig, debug, compress and estimate_progress also take effect when they
+    are set in the Config, and gpx_jobs overrides GPX_JOBS unless it is None.
+    With quiet, nothing is printed except what verbose asks for.
+    """
 
-# Try to parse input file argument already, such that we can at least try to
-# write a FAIL file if -d and something fatal happens in the early stages.
-inputfile = args.inputfile if len(args.inputfile) > 1 else None
+    def __init__(self, keep_orig=False, debug=False, wsl=False, no_postproc=False, force_progress=False,
+                 stream_gpx=False, use_cache=True, recheck=False, verbose=False, quiet=False, profile=False,
+                 compress=False, estimate_progress=False, gpx_jobs=None, verify_gpx=False):
+        self.keep_orig = keep_orig
+        self.debug = debug
+        self.wsl = wsl
+        self.no_postproc = no_postproc
+        self.force_progress = force_progress
+        self.stream_gpx = stream_gpx
+        self.use_cache = use_cache
+        self.recheck = recheck
+        self.verbose = verbose
+        self.quiet = quiet
+        self.profile = profile
+        self.compress = compress
+        self.estimate_progress = estimate_progress
+        self.gpx_jobs = gpx_jobs
+        self.verify_gpx = verify_gpx
 
 
 # SUBROUTINES ####
 
-def do_exit(code):
+def do_exit(code, exit_sleep=None):
     if exit_sleep:
         time.sleep(exit_sleep)
     sys.exit(code)
 
 
 def fatality(err, *msgs):
-    print(*msgs, file=sys.stderr)
-    if debug and fail_file:
-        try:
-            with open(fail_file, 'a') as f_handle:
-                print(*msgs, file=f_handle)
-        except IOError:
-            pass
-    do_exit(err)
+    raise ProcessingError(err, ' '.join(map(str, msgs)))
 
 
 def seppuku(*msgs):
-    err = sys.exc_info()[1]
-    err = os.WEXITSTATUS(os.waitpid(0, 0)[1]) if not err and os.WEXITSTATUS(os.waitpid(0, 0)[1]) else err
-    err = 255 if not err else err
-    fatality(err, *msgs)
+    # Failures while handling an exception get status 1, like exiting with
+    # the exception itself would.
+    fatality(1 if sys.exc_info()[1] else 255, *msgs)
 
 
 def shell_escape(path):
@@ -101,12 +195,9 @@ def shell_escape(path):
     return f'"{path}"'
 
 
-config_warnings = []
-
-
 def read_config(f_path):
-    item_single = {'KEEP_ORIG', 'DEBUG', 'EXTRA_PATH', 'GPX', 'Z_MAX', 'FINAL_Z_MOVE', 'MACHINE'}
-    item_multiple = {'DUALSTRUDE_SCRIPT', 'PWM_SCRIPT', 'RETRACT_SCRIPT'}
+    """Reads the configuration file at f_path into a Config."""
+    config = Config(f_path)
 
     line_comment_re = re.compile(r'^\s*(#.*)?$')
     line_parse_re = re.compile(r'^\s*(\S+)\s*=\s*(.*?)\s*$')
@@ -123,7 +214,7 @@ def read_config(f_path):
                 # Parse the line
                 match = line_parse_re.match(line)
                 if not match:
-                    config_warnings.append(f"Ignored malformed line {n}.")
+                    config.warnings.append(f"Ignored malformed line {n}.")
                     continue
                 item, val = match.groups()
                 vals = []
@@ -132,48 +223,53 @@ def read_config(f_path):
                 else:
                     vals.append(val)
                     if '"' in val:
-                        config_warnings.append(f"Double quote(s) found in value for '{item}' but could not parse as ARRAY, hence interpreted as SINGLE.")
+                        config.warnings.append(f"Double quote(s) found in value for '{item}' but could not parse as ARRAY, hence interpreted as SINGLE.")
 
                 # Assign the variable.
-                if item in item_single:
-                    globals()[item] = vals[0] if vals else ''
+                if item in Config.SINGLE:
+                    setattr(config, item, vals[0] if vals else '')
                     if len(vals) > 1:
-                        config_warnings.append(f"An array was specified for SINGLE item '{item}', only using first element.")
-                elif item in item_multiple:
-                    globals()[item] = vals
+                        config.warnings.append(f"An array was specified for SINGLE item '{item}', only using first element.")
+                elif item in Config.MULTIPLE:
+                    setattr(config, item, vals)
                 else:
-                    config_warnings.append(f"Ignored unknown item '{item}'.")
+                    config.warnings.append(f"Ignored unknown item '{item}'.")
     except IOError:
-        print(f"FATAL: cannot read {f_path}\nPut a readable configuration file at that path, or provide a different one with -f.")
-        sys.exit(1)
+        fatality(1, f"FATAL: cannot read {f_path}\nPut a readable configuration file at that path, or provide a different one with -f.")
+    return config
 
 
-def append_warning(msg):
-    if verbose:
-        print(f"Appending warnings:\n{msg}")
-    try:
-        with open(warn_file, 'a') as fh:
-            print(f"{msg}", file=fh)
-    except IOError:
-        seppuku(f"FATAL: cannot write to {warn_file}: {sys.exc_info()[1]}")
+def config_flag(value):
+    """Interprets a config value like KEEP_ORIG as a boolean."""
+    return str(value).strip() not in ('', '0')
 
 
-def copy_file(in_kind, in_path, out_path):
+def config_number(config, item):
+    """Returns the value of config item as a float."""
+    value = getattr(config, item)
     try:
-        with open(in_path, 'rb') as i_handle, open(out_path, 'wb') as o_handle:
-            while True:
-                chunk = i_handle.read(32768)
-                if not chunk:
-                    break
-                o_handle.write(chunk)
-    except IOError as e:
-        seppuku(f"FATAL: failed to read {in_kind} file '{in_path}': {e}" if 'rb' in e.modes else f"FATAL: failed to write to file '{out_path}': {e}")
+        return float(value)
+    except ValueError:
+        fatality(2, f"ERROR: {item} in the configuration file must be a number: {value}")
 
 
-def gpx_insane(o_handle):
-    gpx_esc = shell_escape(GPX)
-    if not (os.path.isfile(GPX) and os.access(GPX, os.X_OK)):
-        print(f"Check failed: the 'GPX' path was specified but does not point to an executable file: {GPX}", file=o_handle)
+def extend_path(extra_path):
+    """Puts EXTRA_PATH in front of PATH, unless this was done already."""
+    if not extra_path or f"{os.pathsep}{extra_path}{os.pathsep}" in f"{os.pathsep}{os.environ['PATH']}{os.pathsep}":
+        return
+    if os.name == 'nt':
+        os.environ['PATH'] = f"{extra_path};{os.environ['PATH']}"
+    elif re.search(r'(:|^)/usr/bin:', os.environ['PATH']):
+        os.environ['PATH'] = re.sub(r'(:|^)/usr/bin:', lambda m: m.group(1) + extra_path + ':/usr/bin:', os.environ['PATH'], count=1)
+    else:
+        os.environ['PATH'] = f"{extra_path}:{os.environ['PATH']}"
+
+
+def gpx_insane(o_handle, config):
+    gpx = config.GPX
+    gpx_esc = shell_escape(gpx)
+    if not (os.path.isfile(gpx) and os.access(gpx, os.X_OK)):
+        print(f"Check failed: the 'GPX' path was specified but does not point to an executable file: {gpx}", file=o_handle)
         return 1
     try:
         subprocess.check_output(f"{gpx_esc} -? 2>&1", shell=True)
@@ -181,15 +277,15 @@ def gpx_insane(o_handle):
         print(f"Check failed: got unexpected result code when running gpx with -? argument: {sys.exc_info()[1]}", file=o_handle)
         return 1
     try:
-        subprocess.check_output(f"echo T0 | {gpx_esc} -i -m \"{MACHINE}\" 2>&1", shell=True)
+        subprocess.check_output(f"echo T0 | {gpx_esc} -i -m \"{config.MACHINE}\" 2>&1", shell=True)
     except subprocess.CalledProcessError:
-        print(f"Check failed: got error when running gpx with '{MACHINE}' machine type. Make sure this is supported. If not, try setting MACHINE to 'r1d'.", file=o_handle)
+        print(f"Check failed: got error when running gpx with '{config.MACHINE}' machine type. Make sure this is supported. If not, try setting MACHINE to 'r1d'.", file=o_handle)
         return 1
     return 0
 
 
 def postproc_script_insane(o_handle, name, script_config):
-    for exc in script_config[0]:
+    for exc in script_config[:1]:
         if not (os.path.isfile(exc) and os.access(exc, os.X_OK)):
             print(f"Check failed: the first element in the '{name}' list does not point to an executable file: {exc}", file=o_handle)
             return 1
@@ -206,24 +302,22 @@ def postproc_script_insane(o_handle, name, script_config):
     return 0
 
 
-def postproc_script_valid(*script_config):
+def postproc_script_valid(job, script_config):
     if not script_config:
         return 0
 
-    for exc in script_config[0]:
-        if not (os.path.isfile(exc) and os.access(exc, os.X_OK)):
-            if verbose:
-                print(f"'{exc}' is not (an) executable, ignoring.")
+    exc = script_config[0]
+    if not (os.path.isfile(exc) and os.access(exc, os.X_OK)):
+        job.log(f"'{exc}' is not (an) executable, ignoring.", verbose=True)
+        return 0
+    if len(script_config) > 1 and re.search(r'\.p[ly]$', script_config[1], re.I):
+        if not (os.path.isfile(script_config[1]) and os.access(script_config[1], os.R_OK)):
+            job.log(f"'{script_config[1]}' is not a readable script file, ignoring.", verbose=True)
             return 0
-        if len(script_config) > 1 and re.search(r'\.p[ly]$', script_config[1], re.I):
-            if not (os.path.isfile(script_config[1]) and os.access(script_config[1], os.R_OK)):
-                if verbose:
-                    print(f"'{script_config[1]}' is not a readable script file, ignoring.")
-                return 0
     return 1
 
 
-def wsl_insane(o_handle):
+def wsl_insane(o_handle, verbose=False):
     if not os.path.isfile('/proc/version'):
         return 0
     with open('/proc/version', 'r') as proc_f:
@@ -241,251 +335,3304 @@ def wsl_insane(o_handle):
     return 0
 
 
-def sanity_check(o_handle=None):
+def file_identity(path, command=False):
+    """
+    Returns what identifies the current version of an executable or script. If
+    path is a command, a bare name (like python3) is looked up in PATH, as the
+    shell does.
+    """
+    if command and not os.path.dirname(path):
+        path = shutil.which(path) or path
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None
+    return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+
+def cache_home(config):
+    """Returns the directory for files that persist between runs."""
+    if config.CACHE_DIR:
+        return config.CACHE_DIR
+    if os.name == 'nt' and 'LOCALAPPDATA' in os.environ:
+        return os.path.join(os.environ['LOCALAPPDATA'], 'make_fcp_x3g')
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'make_fcp_x3g')
+
+
+def cached_check(checks, results, key, check, o_handle, *args):
+    """
+    Runs check(o_handle, *args) unless checks already holds its outcome for
+    key. The outcome is stored in results, and the check's output is replayed
+    to o_handle either way. Returns the result of the check.
+    """
+    # Changes to this script may change the outcome as well.
+    key = repr((key, file_identity(os.path.abspath(__file__))))
+    if key in checks:
+        results[key] = checks[key]
+    else:
+        out = io.StringIO()
+        results[key] = (check(out, *args), out.getvalue())
+    fail, out = results[key]
+    o_handle.write(out)
+    return fail
+
+
+def sanity_check(config, o_handle=None, recheck=False, verbose=False):
     if o_handle is None:
         o_handle = sys.stderr
 
     # print(f"Running sanity check for script version {VERSION}.\nPATH is:\n{os.environ['PATH']}\n", file=o_handle)
 
+    # The outcome of each check is remembered until the executables involved
+    # change, because running them takes a while.
+    # The file holds the outcomes for all configurations used so far.
+    checks_file = os.path.join(cache_home(config), 'checks.json')
+    stored = {}
+    try:
+        with open(checks_file, 'r') as c_handle:
+            stored = json.load(c_handle)
+    except (IOError, ValueError):
+        pass
+    checks = {} if recheck else stored
+    results = {}
+
     if 'SLIC3R_PP_OUTPUT_NAME' in os.environ:
         print(f"SLIC3R_PP_OUTPUT_NAME is defined:\n{os.environ['SLIC3R_PP_OUTPUT_NAME']}\n", file=o_handle)
     fail = False
-    if GPX:
-        fail = gpx_insane(o_handle)
-    if DUALSTRUDE_SCRIPT:
-        fail = postproc_script_insane(o_handle, 'DUALSTRUDE_SCRIPT', DUALSTRUDE_SCRIPT)
-    if PWM_SCRIPT:
-        fail = postproc_script_insane(o_handle, 'PWM_SCRIPT', PWM_SCRIPT)
-    if RETRACT_SCRIPT:
-        fail = postproc_script_insane(o_handle, 'RETRACT_SCRIPT', RETRACT_SCRIPT)
+    if config.GPX:
+        fail |= cached_check(checks, results, ('GPX', file_identity(config.GPX, True), config.MACHINE), gpx_insane, o_handle, config)
+    for name in Config.MULTIPLE:
+        script_config = getattr(config, name)
+        if script_config:
+            fail |= cached_check(checks, results, (name, [file_identity(path, n == 0) for n, path in enumerate(script_config)]),
+                                 postproc_script_insane, o_handle, name, script_config)
     if os.path.isfile('/proc/version'):
-        fail = wsl_insane(o_handle)
+        wslpath = shutil.which('wslpath')
+        fail |= cached_check(checks, results, ('WSL', file_identity(wslpath) if wslpath else None), wsl_insane, o_handle, verbose)
 
-    if config_warnings:
-        print(f"WARNING: found the following suspect things in the configuration file at '{conf_file}'. Please check the correctness of that file.", file=o_handle)
-        print('\n'.join(config_warnings), file=o_handle)
+    merged = {**stored, **results}
+    if merged != stored:
+        try:
+            os.makedirs(os.path.dirname(checks_file), exist_ok=True)
+            with open(checks_file, 'w') as c_handle:
+                json.dump(merged, c_handle, indent=1)
+        except IOError as e:
+            print(f"Could not save sanity check results to '{checks_file}': {e}", file=sys.stderr)
+
+    if config.warnings:
+        print(f"WARNING: found the following suspect things in the configuration file at '{config.path}'. Please check the correctness of that file.", file=o_handle)
+        print('\n'.join(config.warnings), file=o_handle)
     else:
         if not fail:
             print("All checks seem OK!", file=o_handle)
+    return bool(fail or config.warnings)
 
 
-def run_script(name, gcode, cmd):
-    print(f"Running {name} script...")
-    tmpname = tempfile.mktemp()
+def run_script(job, name, gcode, cmd):
+    job.log(f"Running {name} script...")
+    # The script writes next to gcode, such that its output can simply be
+    # renamed into place.
+    with create_temp(gcode) as o_handle:
+        tmpname = o_handle.name
     cmd = ' '.join(map(shell_escape, cmd))
     tmpname_esc = shell_escape(tmpname)
     gcode_esc = shell_escape(gcode)
 
-    if verbose:
-        print(f"Executing: {cmd} -o {tmpname_esc} {gcode_esc}")
+    job.log(f"Executing: {cmd} -o {tmpname_esc} {gcode_esc}", verbose=True)
     try:
-        warnings = subprocess.check_output(f"{cmd} -o {tmpname_esc} {gcode_esc} 2>&1", shell=True, stderr=subprocess.STDOUT).decode()
+        with job.profiled(f"script:{name}", True):
+            warnings = subprocess.check_output(f"{cmd} -o {tmpname_esc} {gcode_esc} 2>&1", shell=True, stderr=subprocess.STDOUT).decode()
     except subprocess.CalledProcessError as e:
         warnings = f"The {name} script failed ({e.returncode}), but without any output." if not e.output else e.output.decode()
-        with open(fail_file, 'a') as o_handle:
+        discard_temp(tmpname)
+        with open(job.fail_file, 'a') as o_handle:
             print(warnings, file=o_handle)
         seppuku(f"FATAL: running {name} script failed, aborting postprocessing.")
-    copy_file('temporary', tmpname, gcode)
-    os.remove(tmpname)
+    try:
+        commit_file(tmpname, gcode, mode_from=gcode, fsync=job.fsync)
+    except OSError as e:
+        discard_temp(tmpname)
+        seppuku(f"FATAL: failed to write to file '{gcode}': {e}")
 
     if warnings:
-        append_warning(warnings)
+        job.append_warning(warnings)
+
+
+# The final Z move is only looked for in this many lines at the end of the file.
+FINAL_Z_WINDOW = 2048
+
+G1_Z_RE = re.compile(rb'^G1 [^;]*Z(\d*\.?\d+)')
+G1_Z_SUB_RE = re.compile(rb'^(G1 [^;]*Z)\d*\.?\d+(.*)$')
+
+
+def read_tail(f_handle, count, block_size=65536):
+    """
+    Reads the last count lines of a binary file handle by seeking backwards
+    from EOF in blocks, such that only the tail of the file is read. Returns
+    the byte offset of the first returned line, and the lines themselves.
+    """
+    end = f_handle.seek(0, os.SEEK_END)
+    pos = end
+    blocks = []
+    newlines = 0
+    while pos > 0 and newlines <= count:
+        size = min(block_size, pos)
+        pos -= size
+        f_handle.seek(pos)
+        block = f_handle.read(size)
+        blocks.append(block)
+        newlines += block.count(b'\n')
+    lines = io.BytesIO(b''.join(reversed(blocks))).readlines()
+    if pos > 0:
+        # The first line is most likely incomplete.
+        lines = lines[1:]
+    lines = lines[-count:]
+    return end - sum(map(len, lines)), lines
+
+
+def final_z_move_re(final_z_move):
+    return re.compile(rb'^G1 [^;]*Z(\d*\.?\d+).*' + re.escape(final_z_move.encode()))
+
+
+def final_z_warning(highest_z, z_max):
+    """
+    Returns the warning about the highest Z coordinate of a file, if any. If
+    z_max is None, exceeding it is left to a MotionCheck of the whole file.
+    """
+    if highest_z == -1:
+        return 'WARNING: could not find highest Z coordinate. If this is a valid G-code file, the make_fcp_x3g script needs updating.'
+    if z_max is not None and highest_z > int(z_max):
+        return f"WARNING: Z coordinates in this file exceed the maximum: {highest_z} > {z_max}. This print will likely end in disaster."
+    return None
+
+
+def extend_final_z(line, highest_z):
+    return G1_Z_SUB_RE.sub(rf'\g<1>{highest_z}\2 ; EXTENDED!'.encode(), line)
+
+
+def find_final_z(job, f_handle):
+    # Finds the highest Z value in a G1 command from the last FINAL_Z_WINDOW
+    # lines of the file, and if it is higher than the command in the line
+    # containing FINAL_Z_MOVE, works out how to update that line to prevent
+    # the move from ramming the nozzle into the print. Only the tail of the
+    # file is read.
+    # Returns the byte offset of the line, the lines from there to EOF, and
+    # the updated line; or None if nothing needs to be updated.
+    offset, lines = read_tail(f_handle, FINAL_Z_WINDOW)
+
+    highest_z = -1
+    final_z = -1
+    final_index = -1
+
+    final_move_re = final_z_move_re(job.config.FINAL_Z_MOVE)
+    for i, line in enumerate(lines):
+        match = G1_Z_RE.search(line)
+        if match:
+            z = float(match.group(1))
+            highest_z = max(highest_z, z)
+
+            match = final_move_re.search(line)
+            if match:
+                final_z = float(match.group(1))
+                final_index = i
+
+    job.log(f"Highest Z coordinate found: {highest_z}", verbose=True)
+    # Z_MAX is checked on the whole file by check_file_moves.
+    warning = final_z_warning(highest_z, None)
+    if warning:
+        job.append_warning(warning)
+    if highest_z == -1 or final_index < 0 or highest_z <= final_z:
+        return None
+    job.log("Updating final Z move", verbose=True)
+    return offset + sum(map(len, lines[:final_index])), lines[final_index:], extend_final_z(lines[final_index], highest_z)
+
+
+def patch_final_z(f_handle, final):
+    # Rewrites the tail of f_handle from the updated line onwards.
+    offset, lines, patched = final
+    f_handle.seek(offset)
+    f_handle.write(patched)
+    f_handle.writelines(lines[1:])
+    f_handle.truncate()
+
+
+def adjust_final_z(job, path):
+    # Does find_final_z on path, and replaces path with a patched clone. The
+    # updated line is always longer, so the tail after it moves, and
+    # rewriting that in place could be left half done by a crash. It would
+    # also change the backup if path is hard linked to it (see backup_file).
+    # The clone shares its data with path where the filesystem allows, and
+    # is made by the kernel otherwise; only the tail passes through Python.
+    try:
+        with open(path, 'rb') as i_handle:
+            final = find_final_z(job, i_handle)
+            if not final:
+                return
+            o_handle = create_temp(path)
+            try:
+                with o_handle:
+                    clone_file(i_handle.fileno(), o_handle.fileno())
+                    patch_final_z(o_handle, final)
+            except IOError:
+                discard_temp(o_handle.name)
+                raise
+    except IOError as e:
+        seppuku(f"FATAL: cannot open '{path}' for reading+writing: {e}")
+    # Only now that path is closed, as Windows cannot replace open files.
+    try:
+        commit_file(o_handle.name, path, mode_from=path, fsync=job.fsync)
+    except OSError as e:
+        discard_temp(o_handle.name)
+        seppuku(f"FATAL: failed to write to file '{path}': {e}")
+
+
+# FILE COMMITS ####
+#
+# Files are never rewritten where they are. Results go to a temporary file in
+# the same directory, which is renamed over the destination with os.replace
+# once complete, such that a crash cannot leave a half-written file behind.
+# A destination that is a symlink is resolved first, such that its target is
+# replaced rather than the link.
+# With FSYNC = 1, the data and the rename are also flushed to disk first.
+# Copies are made by the OS wherever possible, instead of passing through
+# Python.
+
+# ioctl request for cloning a whole file in Linux (btrfs, XFS and others).
+FICLONE = 0x40049409
+
+
+def create_temp(path):
+    """Creates a temporary file next to path, and returns it open for writing."""
+    directory = os.path.dirname(os.path.realpath(path))
+    try:
+        return tempfile.NamedTemporaryFile(dir=directory, prefix='.make_fcp_x3g_', suffix='.tmp', delete=False)
+    except IOError as e:
+        seppuku(f"FATAL: cannot create temporary file in '{directory}': {e}")
 
 
-def adjust_final_z():
-    # Finds the highest Z value in a G1 command from the last 2048 lines of
-    # inputfile, and if it is higher than the command in the line containing
-    # FINAL_Z_MOVE, it updates that line to prevent the move from ramming the
-    # nozzle into the print.
+def sync_path(path):
+    fd = os.open(path, os.O_RDONLY)
     try:
-        with open(inputfile, 'r+') as f_handle:
-            lines = f_handle.readlines()
-            lines = lines[-2048:]  # get last 2048 lines
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-            highest_z = -1
-            final_z = -1
-            final_index = -1
 
-            pattern1 = re.compile(r'^G1 [^;]*Z(\d*\.?\d+)')
-            pattern2 = re.compile(r'^G1 [^;]*Z(\d*\.?\d+).*' + re.escape(FINAL_Z_MOVE))
-            pattern3 = re.compile(r'^(G1 [^;]*Z)\d*\.?\d+(.*)$')
+def commit_file(tmpname, path, mode_from=None, fsync=False):
+    """
+    Puts the complete temporary file tmpname in place of path, with the
+    permissions of mode_from if given. Otherwise, path keeps its permissions,
+    or gets those of any newly created file.
+    """
+    path = os.path.realpath(path)
+    if mode_from or os.path.exists(path):
+        shutil.copymode(mode_from or path, tmpname)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+    if fsync:
+        sync_path(tmpname)
+    os.replace(tmpname, path)
+    if fsync and os.name == 'posix':
+        sync_path(os.path.dirname(os.path.abspath(path)))
 
-            for i, line in enumerate(lines):
 
-                match = pattern1.search(line)
-                if match:
-                    z = float(match.group(1))
-                    highest_z = max(highest_z, z)
+def discard_temp(tmpname):
+    with contextlib.suppress(OSError):
+        os.remove(tmpname)
 
-                match = pattern2.search(line)
-                if match:
-                    final_z = float(match.group(1))
-                    final_index = i
 
-            if verbose:
-                print(f"Highest Z coordinate found: {highest_z}")
-            if highest_z == -1:
-                append_warning('WARNING: could not find highest Z coordinate. If this is a valid G-code file, the make_fcp_x3g script needs updating.')
+def clone_file(in_fd, out_fd):
+    """
+    Copies everything from file descriptor in_fd to the empty file out_fd, as
+    cheaply as possible: as a reflink sharing the data until either file
+    changes, inside the kernel with copy_file_range or sendfile, or through
+    Python as a last resort.
+    """
+    if fcntl and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(out_fd, FICLONE, in_fd)
+            return
+        except OSError:
+            pass
+    size = os.fstat(in_fd).st_size
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(in_fd, out_fd, size - offset, offset, offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported between these filesystems, continue otherwise.
+            pass
+    os.lseek(out_fd, offset, os.SEEK_SET)
+    if hasattr(os, 'sendfile') and offset < size:
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        except OSError:
+            # Many systems can only send to sockets.
+            os.lseek(out_fd, offset, os.SEEK_SET)
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while True:
+        chunk = os.read(in_fd, 1048576)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(out_fd, view):]
+
+
+def copy_file(in_kind, in_path, out_path, fsync=False, mode_from=None):
+    """Copies in_path to out_path with clone_file, and commits the copy."""
+    try:
+        i_handle = open(in_path, 'rb')
+    except IOError as e:
+        seppuku(f"FATAL: failed to read {in_kind} file '{in_path}': {e}")
+    with i_handle:
+        o_handle = create_temp(out_path)
+        try:
+            with o_handle:
+                clone_file(i_handle.fileno(), o_handle.fileno())
+            commit_file(o_handle.name, out_path, mode_from, fsync)
+        except IOError as e:
+            discard_temp(o_handle.name)
+            seppuku(f"FATAL: failed to write to file '{out_path}': {e}")
+
+
+# Errors of os.link that mean hard links cannot be made there.
+NO_LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK)
+
+
+def backup_file(in_path, out_path, fsync=False):
+    """
+    Makes out_path a copy of in_path that is not affected when in_path is
+    replaced: a hard link where possible, a copy_file otherwise. Afterwards,
+    in_path must only be replaced, not modified in place (see commit_file).
+    """
+    directory = os.path.dirname(os.path.realpath(out_path))
+    for _ in range(tempfile.TMP_MAX):
+        tmpname = os.path.join(directory, f".make_fcp_x3g_{os.urandom(6).hex()}.tmp")
+        try:
+            # Unlike opening, linking never overwrites an existing tmpname.
+            os.link(os.path.realpath(in_path), tmpname)
+            break
+        except FileExistsError:
+            continue
+        except OSError as e:
+            # Windows does not tell these apart as reliably.
+            if e.errno in NO_LINK_ERRORS or os.name != 'posix':
+                # Different filesystems, or no hard links at all.
+                copy_file('original', in_path, out_path, fsync, mode_from=in_path)
                 return
-            if highest_z > int(Z_MAX):
-                append_warning(f"WARNING: Z coordinates in this file exceed the maximum: {highest_z} > {Z_MAX}. This print will likely end in disaster.")
+            seppuku(f"FATAL: failed to write to file '{out_path}': {e}")
+    else:
+        seppuku(f"FATAL: cannot create temporary file in '{directory}'")
+    try:
+        # The link shares its permissions with in_path, which must not change.
+        commit_file(tmpname, out_path, mode_from=in_path, fsync=fsync)
+    except OSError as e:
+        discard_temp(tmpname)
+        seppuku(f"FATAL: failed to write to file '{out_path}': {e}")
 
-            updated = False
 
-            if highest_z > final_z:
-                if verbose:
-                    print("Updating final Z move")
-                # Update the line in memory
-                lines[final_index] = pattern3.sub(rf'\1{highest_z}\2 ; EXTENDED!', lines[final_index])
-                updated = True
+# COMPRESSION ####
+#
+# G-code compressed with gzip, xz or zstd is decompressed while it is read,
+# and compressed again while the result is written if requested, such that no
+# decompressed copy of the input is written along the way. zstd needs either
+# Python 3.14 or the zstandard module.
 
-            # After the loop, write the changes to the file
-            if updated:
-                with open(inputfile, 'w') as f_handle:
-                    f_handle.writelines(lines)
+# Extension and magic bytes of each compression.
+COMPRESSIONS = {
+    'gzip': ('.gz', b'\x1f\x8b'),
+    'xz': ('.xz', b'\xfd7zXZ\x00'),
+    'zstd': ('.zst', b'\x28\xb5\x2f\xfd'),
+}
 
+
+# Raised besides IOError when compressed data is truncated or corrupt.
+DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError) + ((zstd.ZstdError,) if zstd else ())
+
+
+def compression_of(path):
+    """
+    Returns the compression of the file at path going by its magic bytes, or
+    by its extension if it cannot be read. Returns None for plain files.
+    """
+    try:
+        with open(path, 'rb') as i_handle:
+            head = i_handle.read(6)
     except IOError:
-        seppuku(f"FATAL: cannot open '{inputfile}' for reading+writing: {os.strerror()}")
+        head = None
+    for name, (extension, magic) in COMPRESSIONS.items():
+        if head.startswith(magic) if head is not None else path.endswith(extension):
+            return name
+    return None
 
-# Code below is executed when the script is run as a standalone program.
 
+def strip_compression(path):
+    """Returns path without the extension of a compression, if it has one."""
+    for extension, _ in COMPRESSIONS.values():
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
 
-if wsl and inputfile is not None and inputfile != '':
-    # Although the conversion between Windows and Linux paths seems trivial, it
-    # has many quirks so it is better to rely on the dedicated wslpath tool.
-    if verbose:
-        print(f"Converting incoming Windows path '{inputfile}' to UNIX path")
-    in_esc = shell_escape(inputfile)
-    inputfile = subprocess.check_output(f'wslpath -a {in_esc}', shell=True).decode().strip()
-    if inputfile == '':
-        seppuku("FATAL: 'wslpath' command not found or failed")
-    print(f"Converted Windows path to WSL path: '{inputfile}'")
-
-# In case of WSL, this variable must already be converted to a Linux path.
-outputfile = os.environ.get('SLIC3R_PP_OUTPUT_NAME', inputfile)
-
-out_base = outputfile
-if out_base is not None:
-    out_base = os.path.splitext(out_base)[0]
-
-origfile = f"{out_base}_orig.gcode" if out_base is not None else None
-# Avoid making a possibly invisible file
-out_base = 'make_fcp_x3g' if out_base == '' else out_base
-warn_file = f"{out_base}.WARN.txt" if out_base is not None else None
-fail_file = f"{out_base}.FAIL.txt" if out_base is not None else None
-
-if out_base is not None:
-    if os.path.exists(warn_file):
-        os.remove(warn_file)
-    if os.path.exists(fail_file):
-        os.remove(fail_file)
-
-
-if conf_file:
-    read_config(conf_file)
-
-# If config changed these, command line arguments still get precedence
-if args.k:
-    keep_orig = 1
-if args.d:
-    debug = 1
-
-if exit_sleep is not None and not re.match(r'^\d?\.?\d+$', str(exit_sleep)):
-    # Since someone is probably trying to add the -s argument to catch an
-    # error briefly flashing, sleep with a default to show this error.
-    exit_sleep = 3
-    fatality(2, "ERROR: argument following -s must be a positive number")
-
-if EXTRA_PATH:
-    if os.name == 'nt':
-        os.environ['PATH'] = f"{EXTRA_PATH};{os.environ['PATH']}"
-    elif re.search(r'(:|^)/usr/bin:', os.environ['PATH']):
-        os.environ['PATH'] = re.sub(r'(:|^)/usr/bin:', r'\1' + EXTRA_PATH + ':/usr/bin:', os.environ['PATH'])
+
+def zstd_module():
+    if zstd is None:
+        fatality(2, "ERROR: zstd compressed G-code needs Python 3.14 or later, or the zstandard module.")
+    return zstd
+
+
+def open_gcode(path, compression=None):
+    """Opens path for reading, decompressing it on the fly if compression is given."""
+    if not compression:
+        return open(path, 'rb')
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'xz':
+        return lzma.open(path, 'rb')
+    # The reader of the zstandard module cannot read lines by itself.
+    return io.BufferedReader(zstd_module().open(path, 'rb'), 1048576)
+
+
+def compressed_writer(o_handle, compression=None):
+    """
+    Returns a binary file handle that writes everything to o_handle with the
+    given compression. Without compression, o_handle is used as is.
+    """
+    if not compression:
+        return contextlib.nullcontext(o_handle)
+    if compression == 'gzip':
+        # Without name and time stamp, the same result makes the same file.
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=o_handle, mtime=0)
+    if compression == 'xz':
+        return lzma.LZMAFile(o_handle, 'wb')
+    return zstd_module().open(o_handle, 'wb')
+
+
+def decompress_file(path, compression):
+    """Decompresses path into a temporary file next to it, and returns its name."""
+    o_handle = create_temp(path)
+    try:
+        with o_handle, open_gcode(path, compression) as i_handle:
+            shutil.copyfileobj(i_handle, o_handle, 1048576)
+    except (IOError, *DECOMPRESSION_ERRORS) as e:
+        discard_temp(o_handle.name)
+        seppuku(f"FATAL: failed to decompress '{path}': {e}")
+    return o_handle.name
+
+
+# PROFILING ####
+#
+# With --profile, each stage of processing a file and each subprocess is
+# measured, and a report is written to a PROFILE.json file next to the WARN
+# and FAIL files. Without it, the profiler of a Job is None and Job.profiled()
+# hands out a shared no-op context, so the measurements cost nothing.
+
+NOT_PROFILED = contextlib.nullcontext()
+
+
+def read_proc_status(path, fields):
+    """Returns the integer values of the given fields in a /proc file, or None."""
+    values = {}
+    try:
+        with open(path, 'r') as p_handle:
+            for line in p_handle:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    values[name] = int(value.split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+    return values
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, bytes read and written, and peak memory of the
+    stages of processing a file. Stages may overlap (like GPX streaming, which
+    runs during the rewrite pass).
+    I/O counters and per-stage peak memory are only available in Linux, other
+    systems get the peak memory of the whole process so far. The I/O counters
+    include subprocesses once they have finished, but their peak memory is
+    only known as the highest peak of any subprocess finished so far.
+    """
+
+    def __init__(self, path, inputfile):
+        self.path = path
+        self.inputfile = inputfile
+        self.start = time.perf_counter()
+        self.stages = []
+        self.open = []
+
+    def _snapshot(self):
+        times = os.times()
+        snapshot = {
+            'wall': time.perf_counter(),
+            'cpu': time.process_time(),
+            'children_cpu': times.children_user + times.children_system,
+        }
+        io_counts = read_proc_status('/proc/self/io', {'rchar', 'wchar'})
+        if io_counts:
+            snapshot.update(io_counts)
+        return snapshot
+
+    def _fold_peak(self, reset):
+        # Per-stage peaks are obtained by resetting the peak RSS of the
+        # process at the start of each stage. Before doing so, the peak so
+        # far must be attributed to all stages still running.
+        status = read_proc_status('/proc/self/status', {'VmHWM'})
+        if status:
+            peak = status['VmHWM']
+        elif resource:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+        else:
+            return
+        for record in self.open:
+            record['peak_rss_kb'] = max(record.get('peak_rss_kb', 0), peak)
+        if reset and status:
+            try:
+                with open('/proc/self/clear_refs', 'w') as p_handle:
+                    p_handle.write('5')
+            except IOError:
+                pass
+
+    def begin(self, name):
+        self._fold_peak(reset=True)
+        record = {'name': name, 'started_s': time.perf_counter() - self.start, 'before': self._snapshot()}
+        self.open.append(record)
+        return record
+
+    def end(self, record, runs_subprocess=False):
+        self._fold_peak(reset=False)
+        self.open.remove(record)
+        before, after = record.pop('before'), self._snapshot()
+        record['wall_s'] = after['wall'] - before['wall']
+        record['cpu_s'] = after['cpu'] - before['cpu']
+        record['children_cpu_s'] = after['children_cpu'] - before['children_cpu']
+        if 'rchar' in before:
+            record['read_bytes'] = after['rchar'] - before['rchar']
+            record['written_bytes'] = after['wchar'] - before['wchar']
+        if runs_subprocess and resource:
+            record['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+        self.stages.append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, runs_subprocess=False):
+        record = self.begin(name)
+        try:
+            yield record
+        finally:
+            self.end(record, runs_subprocess)
+
+    def write(self):
+        report = {
+            'version': VERSION,
+            'inputfile': self.inputfile,
+            'size_bytes': os.path.getsize(self.inputfile) if self.inputfile and os.path.isfile(self.inputfile) else None,
+            'wall_s': time.perf_counter() - self.start,
+            'stages': self.stages,
+        }
+        try:
+            with open(self.path, 'w') as o_handle:
+                json.dump(report, o_handle, indent=2)
+        except IOError as e:
+            print(f"Could not write profile to '{self.path}': {e}", file=sys.stderr)
+
+
+# STREAMING ENGINE ####
+#
+# All post-processing passes run as a chain of line transforms over a single
+# read of the input file, and a single write of the result. Each stage is a
+# generator taking an iterable of items and a shared context dict, and
+# yielding items. An item is either a line (bytes, including its line ending)
+# or a Deferred placeholder. Stages must pass on items they do not handle
+# untouched, in order.
+
+# Amount of output that may be held back in memory behind an unresolved
+# Deferred line, before it is spilled to a temporary file.
+HOLD_LIMIT = 8 * 1024 * 1024
+
+
+class Deferred:
+    """
+    Placeholder for an output line whose content depends on something that may
+    only be known further down the stream. resolver(line, final) must return
+    the bytes to write, or None if it cannot decide yet. When final is true
+    (the whole input has been read), it must decide.
+    """
+    __slots__ = ('line', 'resolver')
+
+    def __init__(self, line, resolver):
+        self.line = line
+        self.resolver = resolver
+
+    def resolve(self, final=False):
+        return self.resolver(self.line, final)
+
+
+class DeferredWriter:
+    """
+    Writes items to a binary file handle in order. Everything behind an
+    unresolved Deferred is held back until it can be resolved: in memory up to
+    HOLD_LIMIT bytes, in an anonymous temporary file beyond that, such that
+    memory use stays bounded no matter how late the decision is made.
+    """
+
+    def __init__(self, o_handle, hold_limit=HOLD_LIMIT):
+        self.o_handle = o_handle
+        self.hold_limit = hold_limit
+        self.held = deque()
+        self.held_size = 0
+        self.spill = None
+
+    def write(self, item):
+        held = self.held
+        if not held:
+            if item.__class__ is Deferred:
+                line = item.resolve()
+                if line is None:
+                    held.append(item)
+                    return
+                item = line
+            self.o_handle.write(item)
+            return
+
+        if item.__class__ is Deferred:
+            held.append(item)
+        else:
+            if held[-1].__class__ is bytearray:
+                held[-1] += item
+            else:
+                held.append(bytearray(item))
+            self.held_size += len(item)
+        self.flush()
+        if self.held_size > self.hold_limit:
+            self._spill()
+
+    def flush(self, final=False):
+        held = self.held
+        while held:
+            item = held[0]
+            if item.__class__ is Deferred:
+                line = item.resolve(final)
+                if line is None:
+                    return
+                self.o_handle.write(line)
+            elif item.__class__ is tuple:
+                self._unspill(*item)
+            else:
+                self.o_handle.write(item)
+                self.held_size -= len(item)
+            held.popleft()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def _spill(self):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        spill = self.spill
+        spill.seek(0, os.SEEK_END)
+        spilled = deque()
+        for item in self.held:
+            if item.__class__ is bytearray:
+                offset = spill.tell()
+                spill.write(item)
+                if spilled and spilled[-1].__class__ is tuple and sum(spilled[-1]) == offset:
+                    spilled[-1] = (spilled[-1][0], spilled[-1][1] + len(item))
+                else:
+                    spilled.append((offset, len(item)))
+            else:
+                spilled.append(item)
+        self.held = spilled
+        self.held_size = 0
+
+    def _unspill(self, offset, length):
+        spill = self.spill
+        spill.flush()
+        spill.seek(offset)
+        while length > 0:
+            chunk = spill.read(min(length, 1048576))
+            self.o_handle.write(chunk)
+            length -= len(chunk)
+
+
+def run_stages(lines, stages, ctx):
+    """Chains the given stages on top of an iterable of lines."""
+    for stage in stages:
+        lines = stage(lines, ctx)
+    return lines
+
+
+DUAL_MARKER_RE = re.compile(rb'^;- - - Custom G-code for dual extruder printing')
+LEFT_RIGHT_MARKER_RE = re.compile(rb'^;- - - Custom G-code for (left|right) extruder printing')
+M104_SEEN_RE = re.compile(rb'^M104 S.+ T.+; set temperature$')
+M83_RE = re.compile(rb'^M83(;|\s|$)')
+M104_FIX_RE = re.compile(rb'^M104 S(\S+) (T.*); set temperature$')
+G90_RE = re.compile(rb'^(G90 ; use absolute coordinates)$')
+
+
+def detect_markers(lines, ctx):
+    """
+    Sets the 'dualstrude', 'left_right', 'm104_seen' and 'm83_seen' flags in
+    ctx as soon as the corresponding line passes.
+    """
+    for line in lines:
+        if line.startswith(b';- - - Custom G-code for '):
+            if not ctx['dualstrude'] and DUAL_MARKER_RE.match(line):
+                ctx['dualstrude'] = True
+            if not ctx['left_right'] and LEFT_RIGHT_MARKER_RE.match(line):
+                ctx['left_right'] = True
+        elif line.startswith(b'M'):
+            if not ctx['m104_seen'] and M104_SEEN_RE.match(line):
+                ctx['m104_seen'] = True
+            if not ctx['m83_seen'] and M83_RE.match(line):
+                ctx['m83_seen'] = True
+        yield line
+
+
+# For each group of flags: a literal line prefix that can be located with a
+# plain substring search, and the regex each candidate line must then match.
+MARKER_SEARCHES = (
+    (b';- - - Custom G-code for ', (('dualstrude', DUAL_MARKER_RE), ('left_right', LEFT_RIGHT_MARKER_RE))),
+    (b'M104 S', (('m104_seen', M104_SEEN_RE),)),
+    (b'M83', (('m83_seen', M83_RE),)),
+)
+
+
+def prefixed_lines(buf, prefix):
+    """Yields all lines in buf that start with prefix."""
+    if buf[:len(prefix)] == prefix:
+        start = 0
     else:
-        os.environ['PATH'] = f"{EXTRA_PATH}:{os.environ['PATH']}"
+        start = buf.find(b'\n' + prefix) + 1
+        if not start:
+            return
+    while True:
+        end = buf.find(b'\n', start) + 1 or len(buf)
+        yield buf[start:end]
+        start = buf.find(b'\n' + prefix, end - 1) + 1
+        if not start:
+            return
+
+
+def find_markers(buf, pending, flags):
+    """
+    Searches buf, which must start at the beginning of a line, for the lines
+    of MARKER_SEARCHES. pending maps each prefix to the checks that are still
+    unresolved, and is updated along with flags.
+    """
+    for prefix, checks in list(pending.items()):
+        for line in prefixed_lines(buf, prefix):
+            for name, regex in list(checks.items()):
+                if regex.match(line):
+                    flags[name] = True
+                    del checks[name]
+            if not checks:
+                del pending[prefix]
+                break
+
 
-if not inputfile or inputfile == '':
-    fatality(2, "ERROR: argument should be the path to a .gcode file.\nRun this script with -h for usage information.")
+def marker_searches():
+    return {prefix: dict(checks) for prefix, checks in MARKER_SEARCHES}
 
-if debug:
-    check_out = os.path.join(os.path.dirname(outputfile), 'make_fcp_x3g_check.txt')
+
+def scan_markers(path):
+    """
+    Does the same as detect_markers, but up front on the memory-mapped input,
+    without decoding or splitting it into lines. Each group of flags stops
+    searching as soon as it is resolved. Returns a dict with the flags, or
+    None if the file cannot be memory-mapped (e.g. because it is empty).
+    """
+    flags = {}
+    pending = marker_searches()
     try:
-        with open(check_out, 'w') as o_handle:
-            sanity_check()
-    except IOError:
-        seppuku(f"FATAL: cannot write to '{check_out}': {sys.exc_info()[1]}")
-
-if not os.path.isfile(inputfile):
-    fatality(2, f"ERROR: input file not found or is not a file: {inputfile}")
-if not os.access(inputfile, os.R_OK):
-    fatality(2, f"ERROR: input file not readable, maybe insufficient permissions: {inputfile}")
-
-# -p in GPX overrides % display with something that better approximates total
-# print time than merely mapping the Z coordinate to a percentage. It still is
-# not perfect but at least gives a sensible ballpark figure. For this to work
-# properly, cargo cult folklore says that the start GCode block must end with
-# "M73 P1 ;@body", although a peek in GPX source code reveals that either
-# "M73 P1" or @body will work.
-
-arg_p = '-p' if force_progress else ''
-
-if not no_postproc:
-    arg_p = '-p'
-
-    if keep_orig:
-        copy_file('original', inputfile, origfile)
-
-    if FINAL_Z_MOVE:
-        adjust_final_z()
-
-    dualstrude = left_right = m104_seen = m83_seen = fix_m104 = False
-    with open(inputfile, 'rb') as i_handle:
-        for line in i_handle:
-            line = line.decode()
-            if not dualstrude and re.match(r'^;- - - Custom G-code for dual extruder printing', line):
-                dualstrude = True
-            if not left_right and re.match(r'^;- - - Custom G-code for (left|right) extruder printing', line):
-                left_right = True
-            if not m104_seen and re.match(r'^M104 S.+ T.+; set temperature$', line):
-                m104_seen = True
-            if not m83_seen and re.match(r'^M83(;|\s|$)', line):
-                m83_seen = True
-
-    if dualstrude and postproc_script_valid(DUALSTRUDE_SCRIPT):
-        run_script('dualstrusion', inputfile, DUALSTRUDE_SCRIPT)
-    elif left_right and m104_seen:
-        fix_m104 = True
-
-    if fix_m104 or m83_seen:
-        print("Fixing incorrect M104 command for single-extrusion setup") if fix_m104 else None
-        print("Ensuring correct display in gcode.ws") if m83_seen else None
-        with tempfile.NamedTemporaryFile(delete=False) as o_handle:
-            tmpname = o_handle.name
-            with open(inputfile, 'rb') as i_handle:
-                for line in i_handle:
-                    line = line.decode()
-                    if fix_m104:
-                        line = re.sub(r'^M104 S(\S+) (T.*); set temperature$', r'M104 S\1 ; POSTPROCESS FIX: \2 ARGUMENT REMOVED', line)
-                    if m83_seen:
-                        line = re.sub(r'^(G90 ; use absolute coordinates)$', r'\1\nM83; POSTPROCESS workaround for relative E in gcode.ws', line)
-                    o_handle.write(line.encode())
-        copy_file('temporary', tmpname, inputfile)
-        os.unlink(tmpname)
-
-    # if postproc_script_valid(RETRACT_SCRIPT):
-    #     run_script('retraction', inputfile, *RETRACT_SCRIPT)
-
-    # if postproc_script_valid(PWM_SCRIPT):
-    #     run_script('fan PWM post-processing', inputfile, *PWM_SCRIPT)
-
-
-if os.path.isfile(GPX) and os.access(GPX, os.X_OK):
-    print("Invoking GPX...")
-    gpx_esc = shell_escape(GPX)
-    in_esc = shell_escape(inputfile)
-    out_esc = shell_escape(outputfile.rsplit('.gcode', 1)[0] + '.x3g')
-    if verbose:
-        print(f"Executing: {gpx_esc} {arg_p} -m \"{MACHINE}\" {in_esc} {out_esc}")
-    gpx_out = subprocess.check_output(f"{gpx_esc} {arg_p} -m \"{MACHINE}\" {in_esc} {out_esc} 2>&1", shell=True)
-    if verbose and gpx_out:
-        print(gpx_out)
+        with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            find_markers(buf, pending, flags)
+    except (OSError, ValueError):
+        return None
+    for checks in pending.values():
+        flags.update(dict.fromkeys(checks, False))
+    return flags
+
+
+def read_markers(path, compression=None):
+    """
+    Does what scan_markers does for files that cannot be memory-mapped, such
+    as compressed ones, by searching the input in blocks of whole lines. The
+    input is only read until every flag is set.
+    """
+    flags = {}
+    pending = marker_searches()
+    rest = b''
+    try:
+        with open_gcode(path, compression) as i_handle:
+            while pending:
+                block = i_handle.read(PIPE_SIZE)
+                if not block:
+                    find_markers(rest, pending, flags)
+                    break
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                rest = block[end:]
+                find_markers(block[:end], pending, flags)
+    except (IOError, *DECOMPRESSION_ERRORS) as e:
+        seppuku(f"FATAL: failed to read input file '{path}': {e}")
+    for checks in pending.values():
+        flags.update(dict.fromkeys(checks, False))
+    return flags
+
+
+def fix_m104_decided(ctx, final=False):
+    # The M104 fix is only needed for single extrusion prints, i.e. when the
+    # dualstrusion script will not be run. If the flags were obtained with
+    # scan_markers, everything is known from the start.
+    final = final or ctx['scanned']
+    if ctx['dualstrude'] and ctx['dual_ok']:
+        return False
+    if ctx['left_right'] and ctx['m104_seen'] and (final or not ctx['dual_ok']):
+        return True
+    return False if final else None
+
+
+def fix_m104(lines, ctx):
+    """Removes the T argument from M104 commands in single extrusion prints."""
+    def resolver(line, final):
+        fix = fix_m104_decided(ctx, final)
+        if fix is None:
+            return None
+        return M104_FIX_RE.sub(rb'M104 S\1 ; POSTPROCESS FIX: \2 ARGUMENT REMOVED', line) if fix else line
+
+    for line in lines:
+        if line.__class__ is bytes and line.startswith(b'M104 ') and M104_FIX_RE.match(line):
+            yield Deferred(line, resolver)
+        else:
+            yield line
+
+
+def inject_m83(lines, ctx):
+    """
+    Repeats M83 right after G90 if the file uses relative E, such that
+    gcode.ws displays the file correctly.
+    """
+    def resolver(line, final):
+        if ctx['m83_seen']:
+            return G90_RE.sub(rb'\1\nM83; POSTPROCESS workaround for relative E in gcode.ws', line)
+        return line if final or ctx['scanned'] else None
+
+    for line in lines:
+        if line.__class__ is bytes and line.startswith(b'G90 ') and G90_RE.match(line):
+            yield Deferred(line, resolver)
+        else:
+            yield line
+
+
+def patch_lines(lines, ctx):
+    """
+    Replaces the lines starting at the byte offsets of the input given as keys
+    in ctx['patches'], if they still have the expected contents. The values
+    are (expected line, replacement) tuples. Must be the first stage.
+    """
+    patches = ctx['patches']
+    offset = 0
+    for line in lines:
+        if offset in patches and patches[offset][0] == line:
+            yield patches[offset][1]
+        else:
+            yield line
+        offset += len(line)
+
+
+def track_final_z(lines, ctx):
+    """
+    Does what find_final_z does, for input that cannot be read from the end:
+    keeps the Z coordinates of the last FINAL_Z_WINDOW lines, and defers lines
+    containing ctx['final_z_move'] until it is known whether they are the last
+    one within that window. Warnings are passed to ctx['warn'] at the end.
+    """
+    final_move_re = final_z_move_re(ctx['final_z_move'])
+    window = deque(maxlen=FINAL_Z_WINDOW)
+    state = {'count': 0, 'last': 0, 'highest': -1}
+
+    def resolver(n, line, final):
+        if n != state['last'] or state['count'] - n >= FINAL_Z_WINDOW:
+            return line
+        if not final:
+            return None
+        final_z = float(final_move_re.match(line).group(1))
+        return extend_final_z(line, state['highest']) if state['highest'] > final_z else line
+
+    for line in lines:
+        state['count'] += 1
+        z = None
+        if line.__class__ is bytes and line.startswith(b'G1 '):
+            match = G1_Z_RE.match(line)
+            if match:
+                z = float(match.group(1))
+                if final_move_re.match(line):
+                    state['last'] = state['count']
+                    line = Deferred(line, functools.partial(resolver, state['count']))
+        window.append(z)
+        yield line
+
+    state['highest'] = max((z for z in window if z is not None), default=-1)
+    warning = final_z_warning(state['highest'], ctx['z_max'])
+    if warning:
+        ctx['warn'](warning)
+
+
+class TeeWriter:
+    """Writes everything to several binary file handles at once."""
+
+    def __init__(self, *handles):
+        self.handles = handles
+
+    def write(self, data):
+        for handle in self.handles:
+            handle.write(data)
+
+
+def pump_lines(lines, stages, ctx, o_handle):
+    """Writes the result of running the given stages over lines to o_handle."""
+    writer = DeferredWriter(o_handle)
+    for item in run_stages(lines, stages, ctx):
+        writer.write(item)
+    writer.flush(final=True)
+
+
+def process_gcode(in_path, stages, ctx, gpx=None, fsync=False, compression=None, out_path=None, out_compression=None):
+    """
+    Runs the given stages over in_path in a single pass, and atomically
+    replaces in_path, or out_path if given, with the result. compression and
+    out_compression are those of the input and the result. If gpx is a
+    GpxStream, the uncompressed result is also fed to it while it is being
+    produced.
+    """
+    out_path = out_path or in_path
+    o_handle = create_temp(out_path)
+    tmpname = o_handle.name
+    try:
+        with o_handle, open_gcode(in_path, compression) as i_handle, \
+                compressed_writer(o_handle, out_compression) as c_handle:
+            pump_lines(i_handle, stages, ctx, TeeWriter(c_handle, gpx) if gpx else c_handle)
+        commit_file(tmpname, out_path, mode_from=in_path, fsync=fsync)
+    except (IOError, *DECOMPRESSION_ERRORS) as e:
+        discard_temp(tmpname)
+        if gpx:
+            gpx.abort()
+        seppuku(f"FATAL: failed to process '{in_path}': {e}")
+
+
+def new_context(dual_ok=False):
+    """Returns a context for the stages, in which nothing was detected yet."""
+    return {
+        'dualstrude': False,
+        'left_right': False,
+        'm104_seen': False,
+        'm83_seen': False,
+        'scanned': False,
+        'dual_ok': dual_ok,
+        'patches': {},
+    }
+
+
+def iter_lines(chunks):
+    """Splits an iterable of bytes chunks of any size into lines."""
+    rest = b''
+    for chunk in chunks:
+        lines = io.BytesIO(rest + chunk).readlines()
+        rest = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+        yield from lines
+    if rest:
+        yield rest
+
+
+class ChunkList(list):
+    """Collects everything written to it."""
+    write = list.append
+
+
+def resolve_deferred(items, hold_limit=HOLD_LIMIT):
+    """
+    Does what DeferredWriter does, but yields the resolved output as bytes-like
+    chunks instead of writing it to a file.
+    """
+    chunks = ChunkList()
+    writer = DeferredWriter(chunks, hold_limit)
+    for item in items:
+        writer.write(item)
+        if chunks:
+            yield from chunks
+            chunks.clear()
+    writer.flush(final=True)
+    yield from chunks
+
+
+def transform_lines(lines, config, dual_ok=False, warn=None):
+    """
+    Applies the built-in post-processing to an iterable of G-code lines (bytes,
+    each including its line ending), and yields the result as bytes-like
+    chunks. The lines are consumed only once, so they can come from any
+    stream; output that depends on lines further down is held back until it
+    can be decided. dual_ok tells that DUALSTRUDE_SCRIPT will be run on the
+    result of a dual extrusion print. Warnings, including those of a
+    MotionCheck, are passed to warn, if given.
+    """
+    ctx = new_context(dual_ok)
+    ctx.update(config=config, warn=warn or (lambda msg: None))
+    stages = [detect_markers, check_moves, fix_m104, inject_m83]
+    if config.FINAL_Z_MOVE:
+        # Z_MAX is checked by check_moves.
+        ctx.update(final_z_move=config.FINAL_Z_MOVE, z_max=None)
+        stages.insert(2, track_final_z)
+    return resolve_deferred(run_stages(lines, stages, ctx))
+
+
+def transform_bytes(data, config, dual_ok=False, warn=None):
+    """Does transform_lines on a complete G-code file in memory, and returns the result."""
+    return b''.join(transform_lines(iter_lines((data,)), config, dual_ok, warn))
+
+
+# BUILD VOLUME ####
+#
+# Every G0/G1 move in the file is checked against the build volume. The
+# coordinates of the FFCP are relative to the centre of the bed, hence X and Y
+# must stay within -X_MAX..X_MAX and -Y_MAX..Y_MAX, and Z within 0..Z_MAX. To
+# stay fast on files with millions of moves, regexes look up only the numbers
+# that can possibly be out of bounds, and only those few candidates are
+# parsed in Python. Stretches of relative positioning (G91) are rare and
+# short, and are followed line by line from the last absolute position.
+
+MOVE_PREFIXES = (b'G0 ', b'G1 ', b'G0\t', b'G1\t')
+NUMBER_RE = re.compile(rb'-?\d*\.?\d+')
+POSITIONING_RE = re.compile(rb'G9([01])(?![\d.])')
+FIRST_LAYER_RE = re.compile(rb'^(?:G[01][ \t]([^;\n]*)|M8([23])(?!\d)|G9([01])(?![\d.])|G92[ \t]([^;\n]*))', re.M)
+
+
+def at_least_re(n):
+    """Returns a regex for the unsigned integers of at least n."""
+    if n <= 0:
+        return r'\d*'
+    digits = str(n)
+    alternatives = [rf'[1-9]\d{{{len(digits)},}}']
+    for i, digit in enumerate(digits):
+        if digit != '9':
+            alternatives.append(rf'{digits[:i]}[{int(digit) + 1}-9]\d{{{len(digits) - i - 1}}}')
+    alternatives.append(digits)
+    return '|'.join(alternatives)
+
+
+def out_of_bounds_re(axis, low, high):
+    """
+    Returns a regex for all values of axis that may be below low (at most 0) or
+    above high, and then some: candidates must still be checked.
+    """
+    below = at_least_re(math.floor(-low))
+    above = at_least_re(math.floor(high))
+    return re.compile(rf'{axis}(-0*(?:{below})(?:\.\d*)?|0*(?:{above})(?:\.\d*)?)(?![\d.])'.encode())
+
+
+def move_word(buf, pos, start):
+    """
+    Tells whether the word at pos in buf is an argument of a G0/G1 move, rather
+    than part of a comment or of another command. start is where the search for
+    the beginning of its line may stop.
+    """
+    if buf[pos - 1:pos] not in (b' ', b'\t'):
+        return False
+    line = buf.rfind(b'\n', start, pos) + 1 or start
+    return buf[line:line + 3] in MOVE_PREFIXES and buf.find(b';', line, pos) < 0
+
+
+def last_word(buf, axis, start, end):
+    """
+    Returns the offset and value of the last argument axis of a G0/G1 move
+    between start and end, or (-1, None).
+    """
+    pos = end
+    while True:
+        pos = buf.rfind(axis, start, pos)
+        if pos < 0:
+            return -1, None
+        if move_word(buf, pos, start):
+            match = NUMBER_RE.match(buf, pos + 1)
+            if match:
+                return pos, float(match.group())
+
+
+def last_value(buf, axis, start, end):
+    """Returns the last value of axis in a G0/G1 move between start and end, or None."""
+    return last_word(buf, axis, start, end)[1]
+
+
+class MotionCheck:
+    """
+    Checks the G0/G1 moves of a G-code file against X_MAX, Y_MAX and Z_MAX of
+    config, and the height of the first layer against FIRST_LAYER_MAX. An item
+    set to 0 is not checked. The file must be fed in consecutive chunks of
+    complete lines, after which warnings() tells what is wrong with it.
+    """
+
+    def __init__(self, config):
+        self.bounds = {}
+        for axis, item in ((b'X', 'X_MAX'), (b'Y', 'Y_MAX'), (b'Z', 'Z_MAX')):
+            limit = config_number(config, item)
+            if limit > 0:
+                self.bounds[axis] = (0 if axis == b'Z' else -limit, limit)
+        self.first_layer_max = config_number(config, 'FIRST_LAYER_MAX')
+        self.candidates = {axis: out_of_bounds_re(axis.decode(), *limits) for axis, limits in self.bounds.items()}
+        # For each axis and side: number of moves beyond it, the worst value,
+        # and its line number (or offset in the current chunk while feeding).
+        self.beyond = {}
+        self.position = dict.fromkeys(self.bounds)
+        self.relative = False
+        self.lines = 0
+        # Relative E, relative positioning, last E and Z until the first
+        # extruding move is found, then its Z and line.
+        self.layer_state = [False, False, 0.0, None]
+        self.first_layer = None
+
+    def feed(self, buf, start=0, end=None):
+        """Checks buf[start:end], which must start at the beginning of a line."""
+        end = len(buf) if end is None else end
+        self.offsets = {}
+        if self.first_layer is None:
+            self.find_first_layer(buf, start, end)
+        pos = start
+        for match in POSITIONING_RE.finditer(buf, start, end):
+            line = match.start()
+            if line != start and buf[line - 1:line] != b'\n':
+                continue
+            self.check(buf, pos, line)
+            self.relative = match.group(1) == b'1'
+            pos = line
+        self.check(buf, pos, end)
+
+        # Line numbers are only counted for the few offsets that need them.
+        for entry in self.offsets.values():
+            entry[-1] = self.lines + buf[start:entry[-1]].count(b'\n') + 1
+        self.lines += buf[start:end].count(b'\n')
+
+    def found(self, axis, value, offset):
+        low, high = self.bounds[axis]
+        if value < low:
+            side = (axis, low)
+        elif value > high:
+            side = (axis, high)
+        else:
+            return
+        entry = self.beyond.get(side)
+        if entry is None:
+            entry = self.beyond[side] = [0, value, offset]
+            self.offsets[id(entry)] = entry
+        elif value < entry[1] if value < low else value > entry[1]:
+            entry[1:] = [value, offset]
+            self.offsets[id(entry)] = entry
+        entry[0] += 1
+
+    def check(self, buf, start, end):
+        if start >= end:
+            return
+        if self.relative:
+            self.walk(buf, start, end)
+            return
+        for axis, regex in self.candidates.items():
+            for match in regex.finditer(buf, start, end):
+                if move_word(buf, match.start(), start):
+                    try:
+                        self.found(axis, float(match.group(1)), match.start())
+                    except ValueError:
+                        pass
+            value = last_value(buf, axis, start, end)
+            if value is not None:
+                self.position[axis] = value
+
+    def walk(self, buf, start, end):
+        """Follows the moves between start and end in relative positioning."""
+        pos = start
+        while pos < end:
+            eol = buf.find(b'\n', pos, end)
+            eol = end if eol < 0 else eol + 1
+            line = buf[pos:eol]
+            if line[:3] in MOVE_PREFIXES:
+                for word in line.split(b';', 1)[0].split()[1:]:
+                    axis = word[:1]
+                    if self.position.get(axis) is None:
+                        continue
+                    try:
+                        self.position[axis] += float(word[1:])
+                    except ValueError:
+                        continue
+                    self.found(axis, self.position[axis], pos)
+            pos = eol
+
+    def find_first_layer(self, buf, start, end):
+        """Follows the moves up to the first one that extrudes while moving in X or Y."""
+        state = self.layer_state
+        for match in FIRST_LAYER_RE.finditer(buf, start, end):
+            move, extrusion, positioning, reset = match.groups()
+            if extrusion:
+                state[0] = extrusion == b'3'
+            elif positioning:
+                state[1] = positioning == b'1'
+            elif reset is not None:
+                # Without arguments, all axes are reset.
+                reset_e = re.search(rb'(?:^|\s)E(-?\d*\.?\d+)', reset)
+                if reset_e or not reset.strip():
+                    state[2] = float(reset_e.group(1)) if reset_e else 0.0
+            else:
+                words = {word[:1]: word[1:] for word in move.split()}
+                try:
+                    if b'Z' in words:
+                        z = float(words[b'Z'])
+                        state[3] = z if not state[1] else None if state[3] is None else state[3] + z
+                    e = float(words[b'E']) if b'E' in words else None
+                except ValueError:
+                    continue
+                if e is None:
+                    continue
+                relative = state[0] or state[1]
+                extruding = e > 0 if relative else e > state[2]
+                if not relative:
+                    state[2] = e
+                if extruding and (b'X' in words or b'Y' in words):
+                    self.first_layer = [state[3], match.start()]
+                    self.offsets[id(self.first_layer)] = self.first_layer
+                    return
+
+    def merge(self, other):
+        """
+        Takes over what other found in the part of the file that follows
+        everything fed to this one.
+        """
+        for side, (count, value, line) in other.beyond.items():
+            entry = self.beyond.get(side)
+            if entry is None:
+                self.beyond[side] = [count, value, self.lines + line]
+                continue
+            entry[0] += count
+            if value < entry[1] if value < side[1] else value > entry[1]:
+                entry[1:] = [value, self.lines + line]
+        if self.first_layer is None and other.first_layer is not None:
+            self.first_layer = [other.first_layer[0], self.lines + other.first_layer[1]]
+        self.lines += other.lines
+
+    def warnings(self):
+        """Returns a list of warnings about everything found."""
+        warnings = []
+        for (axis, limit), (count, value, line) in sorted(self.beyond.items()):
+            axis = axis.decode()
+            if value < limit:
+                what = 'below the bed' if axis == 'Z' else f"below the minimum of {limit:g}"
+                warnings.append(f"WARNING: {count} move(s) in this file go {what} in {axis}, down to {value:g} at line {line}. This print will likely end in disaster.")
+            else:
+                warnings.append(f"WARNING: {axis} coordinates in this file exceed the maximum: {value:g} > {limit:g} at line {line}, in {count} move(s). This print will likely end in disaster.")
+        if self.first_layer and self.first_layer[0] is not None:
+            z, line = self.first_layer
+            if z <= 0:
+                warnings.append(f"WARNING: the first layer is printed at Z {z:g} (line {line}), which is not above the bed.")
+            elif self.first_layer_max > 0 and z > self.first_layer_max:
+                warnings.append(f"WARNING: the first layer is printed at Z {z:g} (line {line}), which is more than FIRST_LAYER_MAX ({self.first_layer_max:g}). It will likely not stick to the bed.")
+        return warnings
+
+
+def check_file_moves(job, path, ranges=None):
+    """
+    Does a MotionCheck on the memory-mapped file at path, and appends its
+    warnings. If ranges are given, they are checked in parallel.
+    """
+    motion = MotionCheck(job.config)
+    try:
+        if ranges:
+            for part in map_ranges(check_range, path, ranges, job.config):
+                motion.merge(part)
+        elif os.path.getsize(path):
+            with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                motion.feed(buf)
+    except OSError as e:
+        seppuku(f"FATAL: failed to read input file '{path}': {e}")
+    for warning in motion.warnings():
+        job.append_warning(warning)
+
+
+# Lines fed at once by check_moves.
+CHECK_CHUNK_LINES = 16384
+
+
+def check_moves(lines, ctx):
+    """
+    Does a MotionCheck on a stream of lines, for input that cannot be
+    memory-mapped. Must come before any stage that yields Deferred items.
+    Warnings are passed to ctx['warn'] at the end.
+    """
+    motion = MotionCheck(ctx['config'])
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHECK_CHUNK_LINES:
+            motion.feed(b''.join(chunk))
+            chunk = []
+        yield line
+    if chunk:
+        motion.feed(b''.join(chunk))
+    for warning in motion.warnings():
+        ctx['warn'](warning)
+
+
+# PRINT TIME ####
+#
+# GPX can only spread build progress over the file with its -p option, which
+# needs an extra pass over its input, cannot be used on a stream, and ignores
+# acceleration. Instead, the duration of every move can be estimated here from
+# its feedrate and the motion limits of the FFCP, and M73 commands with the
+# progress and remaining time inserted before every layer change.
+
+# Maximum speed (mm/s), acceleration (mm/s²) and speed change at a junction
+# (mm/s) of the FFCP with stock Sailfish settings, for X and Y, Z, and the
+# extruders.
+SPEED_XY, SPEED_Z, SPEED_E = 300.0, 19.5, 26.7
+ACCEL_XY, ACCEL_Z, ACCEL_E = 1000.0, 150.0, 2000.0
+JERK_XY, JERK_Z, JERK_E = 20.0, 10.0, 20.0
+
+# Comments with which slicers start a layer.
+LAYER_MARKERS = (b';LAYER_CHANGE', b';LAYER:')
+DWELL_RE = re.compile(rb'\s([PS])(\d*\.?\d+)')
+G92_RE = re.compile(rb'^G92(?![\d.])([^;\n]*)', re.M)
+
+
+def move_time(d, v, a, v0, v1):
+    """
+    Returns the time a move of length d takes when it accelerates at a towards
+    speed v, entering at speed v0 and leaving at v1.
+    """
+    ramps = (2 * v * v - v0 * v0 - v1 * v1) / (2 * a)
+    if ramps <= d:
+        return (2 * v - v0 - v1) / a + (d - ramps) / v
+    # Too short to reach v.
+    peak = math.sqrt(a * d + (v0 * v0 + v1 * v1) / 2)
+    if peak < v0 or peak < v1:
+        return 2 * d / (v0 + v1)
+    return (2 * peak - v0 - v1) / a
+
+
+def estimate_print_time(lines, offset=0, state=None):
+    """
+    Estimates how long it takes to print an iterable of G-code lines (bytes).
+    Every move accelerates and decelerates within the limits of the slowest
+    axis involved, and keeps as much speed through a junction as the change of
+    direction allows. Heating and homing are not counted. Returns the total in
+    seconds, and for every layer change the byte offset and contents of its
+    marker line, and the time elapsed before it.
+    If the lines do not start the file, offset is where they start, and state
+    what motion_state returns for that offset.
+    """
+    sqrt = math.sqrt
+    X, Y, Z, E, F = b'XYZEF'
+    x, y, z, e, feedrate, relative_e = state or (0.0, 0.0, 0.0, 0.0, 25.0, False)
+    relative = False
+    total = 0.0
+    layers = []
+    # The last move, which can only be finished when it is known how fast the
+    # next one may take over: length, speed, acceleration and entry speed.
+    pending = None
+    # Direction and speed of the last move.
+    px = py = pz = 0.0
+    pv = 0.0
+    for line in lines:
+        start = offset
+        offset += len(line)
+        head = line[:2]
+        if (head == b'G1' or head == b'G0') and not line[2:3].isdigit():
+            comment = line.find(b';')
+            dx = dy = dz = de = 0.0
+            try:
+                for word in (line if comment < 0 else line[:comment]).split()[1:]:
+                    axis = word[0]
+                    if axis == X:
+                        dx = float(word[1:]) if relative else float(word[1:]) - x
+                    elif axis == Y:
+                        dy = float(word[1:]) if relative else float(word[1:]) - y
+                    elif axis == E:
+                        de = float(word[1:]) if relative or relative_e else float(word[1:]) - e
+                    elif axis == Z:
+                        dz = float(word[1:]) if relative else float(word[1:]) - z
+                    elif axis == F:
+                        feedrate = float(word[1:]) / 60
+            except ValueError:
+                continue
+            x += dx
+            y += dy
+            z += dz
+            e += de
+            d = sqrt(dx * dx + dy * dy + dz * dz)
+            if d == 0.0:
+                if de:
+                    # Retraction or priming, which starts and ends at rest.
+                    if pending:
+                        total += move_time(*pending, 0.0)
+                        pending = None
+                        pv = 0.0
+                    v = feedrate if feedrate < SPEED_E else SPEED_E
+                    j = v if v < JERK_E else JERK_E
+                    total += move_time(abs(de), v, ACCEL_E, j, j)
+                continue
+
+            v = feedrate if feedrate < SPEED_XY else SPEED_XY
+            a = ACCEL_XY
+            if dz:
+                ratio = abs(dz) / d
+                if v * ratio > SPEED_Z:
+                    v = SPEED_Z / ratio
+                if a * ratio > ACCEL_Z:
+                    a = ACCEL_Z / ratio
+            if de:
+                ratio = abs(de) / d
+                if v * ratio > SPEED_E:
+                    v = SPEED_E / ratio
+                if a * ratio > ACCEL_E:
+                    a = ACCEL_E / ratio
+
+            ux = dx / d
+            uy = dy / d
+            uz = dz / d
+            if pending:
+                # The speed through the junction is limited by how much the
+                # speed of each axis changes.
+                j = v if v < pv else pv
+                change = abs(ux - px)
+                if change * j > JERK_XY:
+                    j = JERK_XY / change
+                change = abs(uy - py)
+                if change * j > JERK_XY:
+                    j = JERK_XY / change
+                if uz or pz:
+                    change = abs(uz - pz)
+                    if change * j > JERK_Z:
+                        j = JERK_Z / change
+                total += move_time(*pending, j)
+            else:
+                j = 0.0
+            pending = (d, v, a, j)
+            px, py, pz, pv = ux, uy, uz, v
+        elif line.startswith(LAYER_MARKERS):
+            if pending:
+                total += move_time(*pending, 0.0)
+                pending = None
+                pv = 0.0
+            layers.append((start, line, total))
+        elif head == b'G9' and not line[3:4].isdigit():
+            if line[2:3] in (b'0', b'1'):
+                relative = line[2:3] == b'1'
+            elif line[2:3] == b'2':
+                comment = line.find(b';')
+                words = (line if comment < 0 else line[:comment]).split()[1:]
+                try:
+                    for word in words or (b'X0', b'Y0', b'Z0', b'E0'):
+                        axis = word[0]
+                        if axis == X:
+                            x = float(word[1:])
+                        elif axis == Y:
+                            y = float(word[1:])
+                        elif axis == Z:
+                            z = float(word[1:])
+                        elif axis == E:
+                            e = float(word[1:])
+                except ValueError:
+                    pass
+        elif head == b'M8':
+            if line[:3] in (b'M82', b'M83') and not line[3:4].isdigit():
+                relative_e = line[2:3] == b'3'
+        elif head == b'G4' and not line[2:3].isdigit():
+            # Dwell, for P milliseconds or S seconds.
+            if pending:
+                total += move_time(*pending, 0.0)
+                pending = None
+                pv = 0.0
+            match = DWELL_RE.search(line.split(b';', 1)[0])
+            if match:
+                total += float(match.group(2)) / (1000 if match.group(1) == b'P' else 1)
+    if pending:
+        total += move_time(*pending, 0.0)
+    return total, layers
+
+
+def progress_line(elapsed, total):
+    """Returns an M73 command with the progress and remaining minutes after elapsed seconds."""
+    percent = int(elapsed * 100 / total) if total else 0
+    return f"M73 P{percent} R{round((total - elapsed) / 60)} ; POSTPROCESS progress estimate\n".encode()
+
+
+def estimate_progress(job, path, ctx, ranges=None):
+    """
+    Estimates the print time of the input file at path, and adds patches to
+    ctx that insert progress_line before every layer change. Returns whether
+    any layer changes were found. If ranges are given, they are estimated in
+    parallel.
+    """
+    try:
+        if ranges:
+            total, layers = 0.0, []
+            for part_total, part_layers in map_ranges(estimate_range, path, ranges):
+                layers += [(offset, line, total + elapsed) for offset, line, elapsed in part_layers]
+                total += part_total
+        else:
+            with open_gcode(path, job.compression) as i_handle:
+                total, layers = estimate_print_time(i_handle)
+    except (IOError, *DECOMPRESSION_ERRORS) as e:
+        seppuku(f"FATAL: failed to read input file '{path}': {e}")
+    if not layers:
+        job.log("No layer changes found, leaving build progress to GPX")
+        return False
+    job.log(f"Estimated print time: {int(total // 3600)}h{int(total % 3600 // 60):02}m")
+    for offset, line, elapsed in layers:
+        ctx['patches'][offset] = (line, progress_line(elapsed, total) + line)
+    return True
+
+
+# PARALLEL SCAN ####
+#
+# Files of at least PARALLEL_SCAN_SIZE megabytes are checked and estimated on
+# all CPU cores: the memory-mapped file is split into ranges, each range is
+# scanned by a worker process, and the partial results are merged in order.
+# Ranges start at a layer change where possible, and never in relative
+# positioning, such that hardly any state must be carried across them.
+
+# How many times as long estimating the print time of a megabyte of G-code
+# takes as a MotionCheck of it. The parallel estimate pays off from a
+# correspondingly smaller file size.
+ESTIMATE_COST = 8
+
+
+def scan_ranges(job, path, cost=1):
+    """
+    Returns the (start, end) byte ranges in which the file at path is to be
+    scanned in parallel, or None if it is better scanned in one go. cost tells
+    how many times as long as a MotionCheck the scan takes.
+    """
+    workers = os.cpu_count() or 1
+    limit = config_number(job.config, 'PARALLEL_SCAN_SIZE') * 1048576 / cost
+    # Batch workers already keep all cores busy.
+    if workers < 2 or limit <= 0 or worker_config is not None:
+        return None
+    try:
+        if os.path.getsize(path) < limit:
+            return None
+        with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            ranges = split_ranges(buf, workers)
+    except OSError:
+        # Then it will fail in one go, with a proper error.
+        return None
+    return ranges if len(ranges) > 1 else None
+
+
+def split_ranges(buf, count, layers_only=False):
+    """
+    Splits buf into at most count ranges of about equal size, each starting at
+    the beginning of a line in absolute positioning, preferably a layer change,
+    or with layers_only, only ever at a layer change.
+    """
+    size = len(buf)
+    # Offsets where positioning changes, and whether it becomes relative.
+    switches = [(match.start(), match.group(1) == b'1') for match in POSITIONING_RE.finditer(buf)
+                if buf[match.start() - 1:match.start()] in (b'', b'\n')]
+    offsets = [switch[0] for switch in switches]
+    bounds = [0]
+    for n in range(1, count):
+        start = max(size * n // count, bounds[-1])
+        while True:
+            layer = min((found for found in (buf.find(b'\n' + marker, start) for marker in LAYER_MARKERS) if found >= 0),
+                        default=-1 if layers_only else buf.find(b'\n', start))
+            start = layer + 1 if layer >= 0 else size
+            i = bisect.bisect_right(offsets, start) - 1
+            if start >= size or i < 0 or not switches[i][1]:
+                break
+            if not layers_only:
+                # Move on to where absolute positioning resumes.
+                start = next((offset for offset, relative in switches[i + 1:] if not relative), size)
+                break
+        if start >= size:
+            break
+        if start > bounds[-1]:
+            bounds.append(start)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def map_ranges(worker, path, ranges, *args):
+    """
+    Runs worker(path, start, end, *args) for all ranges in a pool of processes,
+    and returns the results in the order of the ranges.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [pool.submit(worker, path, start, end, *args) for start, end in ranges]
+        return [future.result() for future in futures]
+
+
+def relative_moves(buf, axis, start, end, value):
+    """Adds what axis moves in the relative moves between start and end of buf to value."""
+    pos = start
+    while True:
+        pos = buf.find(axis, pos, end)
+        if pos < 0:
+            return value
+        if move_word(buf, pos, start):
+            match = NUMBER_RE.match(buf, pos + 1)
+            if match:
+                value += float(match.group())
+        pos += 1
+
+
+def axis_position(buf, axis, end, g92=False):
+    """
+    Returns the position of axis at offset end of buf, as it is after feeding
+    everything before to a MotionCheck: its last value in absolute positioning,
+    plus all it moved in relative positioning since, or None if it was never
+    set. With g92, it starts at 0 and G92 also sets it, as estimate_print_time
+    and GPX have it.
+    """
+    pos = end
+    while True:
+        pos, value = last_word(buf, axis, 0, pos)
+        relative = buf.rfind(b'\nG91', 0, pos)
+        if pos < 0 or relative <= buf.rfind(b'\nG90', 0, pos):
+            break
+        pos = relative
+    if g92:
+        for match in G92_RE.finditer(buf, max(pos, 0), end):
+            # Without arguments, all axes are reset.
+            word = re.search(rb'(?:^|\s)' + axis + rb'(-?\d*\.?\d+)', match.group(1))
+            if word or not match.group(1).strip():
+                pos, value = match.start(), float(word.group(1)) if word else 0.0
+        if value is None:
+            pos, value = 0, 0.0
+    if value is None:
+        return None
+
+    # Replay the relative positioning since, which may already be going on.
+    span = pos if buf.rfind(b'\nG91', 0, pos) > buf.rfind(b'\nG90', 0, pos) else None
+    for match in POSITIONING_RE.finditer(buf, pos, end):
+        line = match.start()
+        if line and buf[line - 1:line] != b'\n':
+            continue
+        if match.group(1) == b'1':
+            span = line if span is None else span
+        elif span is not None:
+            value = relative_moves(buf, axis, span, line, value)
+            span = None
+    if span is not None:
+        value = relative_moves(buf, axis, span, end, value)
+    return value
+
+
+def check_range(path, start, end, config):
+    """Does a MotionCheck on a range of the file at path, and returns it."""
+    motion = MotionCheck(config)
+    with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for axis in motion.position:
+            motion.position[axis] = axis_position(buf, axis, start)
+        motion.feed(buf, start, end)
+    return motion
+
+
+def motion_state(buf, end):
+    """
+    Returns the state of estimate_print_time at offset end of buf, where
+    positioning must be absolute: the position of X, Y, Z and E, the feedrate,
+    and whether E is relative.
+    """
+    x, y, z, e = (axis_position(buf, axis, end, g92=True) for axis in (b'X', b'Y', b'Z', b'E'))
+    feedrate = last_value(buf, b'F', 0, end)
+    relative_e = buf.rfind(b'\nM83', 0, end) > buf.rfind(b'\nM82', 0, end)
+    return x, y, z, e, feedrate / 60 if feedrate else 25.0, relative_e
+
+
+def estimate_range(path, start, end):
+    """Does estimate_print_time on a range of the file at path."""
+    with open(path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        state = motion_state(buf, start)
+        return estimate_print_time(io.BytesIO(buf[start:end]), start, state)
+
+
+# X3G ####
+#
+# An X3G file is a plain sequence of commands for the Sailfish firmware: a
+# command byte followed by a payload, in which all numbers are little-endian.
+
+# Payload length of every command. Commands 149 and 153 are followed by a
+# NUL-terminated string on top of this, and command 136 by as many bytes as
+# its third payload byte says.
+X3G_PAYLOAD = {
+    131: 7, 132: 7, 133: 4, 134: 1, 135: 5, 136: 3, 137: 1, 138: 16, 139: 24, 140: 20,
+    141: 5, 142: 25, 143: 1, 144: 1, 145: 2, 146: 5, 147: 5, 148: 4, 149: 4, 150: 2,
+    151: 1, 152: 1, 153: 4, 154: 1, 155: 31, 156: 1, 157: 20, 158: 4,
+}
+
+X3G_DELAY = 133
+X3G_TOOL_ACTION = 136
+X3G_STRINGS = (149, 153)
+
+
+def x3g_command_end(buf, pos, end=None):
+    """
+    Returns the offset right after the command at offset pos of buf, -1 if it
+    does not end before end (by default the end of buf), or None if it is not
+    a known command.
+    """
+    end = len(buf) if end is None else end
+    command = buf[pos]
+    length = X3G_PAYLOAD.get(command)
+    if length is None:
+        return None
+    after = pos + 1 + length
+    if command == X3G_TOOL_ACTION:
+        if after > end:
+            return -1
+        after += buf[pos + 3]
+    elif command in X3G_STRINGS:
+        nul = buf.find(b'\0', after, end)
+        if nul < 0:
+            return -1
+        after = nul + 1
+    return after if after <= end else -1
+
+
+X3G_ABSOLUTE_MOVE = 139
+X3G_MOVES = (X3G_ABSOLUTE_MOVE, 142, 155)
+X3G_CHANGE_TOOL = 134
+X3G_SET_POSITION = 140
+X3G_EXTENDED_MOVE = 155
+
+# Steps per mm of the Z axis of the FFCP.
+X3G_Z_STEPS = 400
+
+# In moves and positions, Z is the third int32 after the command byte. Moves
+# 142 and 155 have a bitmask of relative axes after the axes and the DDA rate.
+X3G_Z = struct.Struct('<i')
+X3G_RELATIVE = 25
+X3G_Z_RELATIVE = 4
+
+# Command 155 moves, by far the most common commands, are decoded in batches
+# of this many with a few calls that each go through the whole batch in C.
+MOVE_SIZE = 1 + X3G_PAYLOAD[X3G_EXTENDED_MOVE]
+MOVE_BATCH = 256
+MOVE_Z = struct.Struct(f'<9xi{MOVE_SIZE - 13}x')
+NOT_Z_RELATIVE = bytes(flags for flags in range(256) if not flags & X3G_Z_RELATIVE)
+
+# Size of the chunks in which X3G files are read.
+X3G_CHUNK = 1048576
+
+
+class X3gInspector:
+    """
+    Decodes an X3G file fed in consecutive chunks, and counts its commands,
+    while keeping track of the highest Z (in steps) it moves to. Decoding
+    stops at the first unknown command, which is kept in error.
+    """
+
+    def __init__(self):
+        self.counts = [0] * 256
+        self.z = None
+        self.max_z = None
+        self.offset = 0
+        self.error = None
+
+    def feed(self, buf, end):
+        """
+        Decodes the commands in buf[:end] that are complete, and returns the
+        offset of the first one that is not, from where to continue in the
+        next chunk.
+        """
+        counts = self.counts
+        pos = 0
+        while pos < end:
+            command = buf[pos]
+            if command == X3G_EXTENDED_MOVE:
+                after = self.feed_moves(buf, pos, end)
+                if after == pos:
+                    break
+                pos = after
+                continue
+            after = x3g_command_end(buf, pos, end)
+            if after is None:
+                self.error = f"unknown command {command} at byte {self.offset + pos}"
+                break
+            if after < 0:
+                break
+            counts[command] += 1
+            if command in X3G_MOVES:
+                self.move_z(buf, pos, command != X3G_ABSOLUTE_MOVE and buf[pos + X3G_RELATIVE] & X3G_Z_RELATIVE)
+            elif command == X3G_SET_POSITION:
+                self.z = X3G_Z.unpack_from(buf, pos + 9)[0]
+            pos = after
+        self.offset += pos
+        return pos
+
+    def move_z(self, buf, pos, relative):
+        z = X3G_Z.unpack_from(buf, pos + 9)[0]
+        if relative:
+            if self.z is None:
+                return
+            z += self.z
+        self.z = z
+        if self.max_z is None or z > self.max_z:
+            self.max_z = z
+
+    def feed_moves(self, buf, pos, end):
+        """Decodes the command 155 moves from pos onwards, and returns the offset after them."""
+        while True:
+            stop = min(end, pos + MOVE_SIZE * MOVE_BATCH)
+            commands = buf[pos:stop:MOVE_SIZE]
+            count = min(len(commands) - len(commands.lstrip(bytes([X3G_EXTENDED_MOVE]))), (stop - pos) // MOVE_SIZE)
+            if not count:
+                return pos
+            stop = pos + count * MOVE_SIZE
+            if buf[pos + X3G_RELATIVE:stop:MOVE_SIZE].translate(None, NOT_Z_RELATIVE):
+                for at in range(pos, stop, MOVE_SIZE):
+                    self.move_z(buf, at, buf[at + X3G_RELATIVE] & X3G_Z_RELATIVE)
+            else:
+                top = max(MOVE_Z.iter_unpack(buf[pos:stop]))[0]
+                if self.max_z is None or top > self.max_z:
+                    self.max_z = top
+                self.z = MOVE_Z.unpack_from(buf, stop - MOVE_SIZE)[0]
+            self.counts[X3G_EXTENDED_MOVE] += count
+            pos = stop
+
+    def summary(self):
+        """Returns a line with the numbers that matter most."""
+        moves = sum(self.counts[command] for command in X3G_MOVES)
+        max_z = 'none' if self.max_z is None else f"{self.max_z / X3G_Z_STEPS:g}mm"
+        return (f"X3G file: {sum(self.counts)} commands, {moves} moves, "
+                f"{self.counts[X3G_CHANGE_TOOL]} tool changes, highest Z {max_z}")
+
+    def command_counts(self):
+        """Returns a line with the number of every command found."""
+        return ', '.join(f"{command}: {count}" for command, count in enumerate(self.counts) if count)
+
+
+def inspect_x3g(job, path):
+    """
+    Decodes the X3G file at path with an X3gInspector, reading it in chunks
+    such that files of any size take little memory. Logs what is in it, and
+    appends a warning if it is corrupt, truncated or without moves.
+    """
+    inspector = X3gInspector()
+    buf = bytearray(X3G_CHUNK)
+    kept = 0
+    try:
+        with open(path, 'rb') as i_handle, memoryview(buf) as view:
+            while True:
+                read = i_handle.readinto(view[kept:])
+                end = kept + read
+                used = inspector.feed(buf, end)
+                kept = end - used
+                if inspector.error or not read:
+                    break
+                if kept == len(buf):
+                    # A single command cannot be this long.
+                    inspector.error = f"overly long command {buf[0]} at byte {inspector.offset}"
+                    break
+                view[:kept] = buf[used:end]
+    except OSError as e:
+        seppuku(f"FATAL: failed to read X3G file '{path}': {e}")
+
+    job.log(inspector.summary())
+    job.log(f"X3G commands: {inspector.command_counts()}", verbose=True)
+    if inspector.error:
+        job.append_warning(f"WARNING: the X3G file is corrupt, it contains an {inspector.error}. "
+                           f"Do not print it.")
+    elif kept:
+        job.append_warning(f"WARNING: the X3G file is truncated, its last command at byte {inspector.offset} "
+                           f"is incomplete. Do not print it.")
+    elif not any(inspector.counts[command] for command in X3G_MOVES):
+        job.append_warning("WARNING: the X3G file does not contain a single move.")
+    return inspector
+
+
+# GPX ####
+
+def gpx_usable(config):
+    return config.GPX and os.path.isfile(config.GPX) and os.access(config.GPX, os.X_OK)
+
+
+def gpx_command(job, in_path, out_path, arg_p):
+    cmd = f"{shell_escape(job.config.GPX)} {arg_p} -m \"{job.config.MACHINE}\" {shell_escape(in_path)} {shell_escape(out_path)}"
+    job.log(f"Executing: {cmd}", verbose=True)
+    return f"{cmd} 2>&1"
+
+
+def gpx_failed(job, returncode, gpx_out):
+    """Writes what GPX printed to the FAIL file, and aborts."""
+    fail_file = job.fail_file
+    with open(fail_file, 'a') as o_handle:
+        print(gpx_out or f"GPX failed ({returncode}), but without any output.", file=o_handle)
+    fatality(returncode or 255, f"FATAL: GPX failed ({returncode}), see {fail_file}")
+
+
+def run_gpx(job, in_path, out_path, arg_p):
+    job.log("Invoking GPX...")
+    # Until GPX has succeeded, any previous out_path stays.
+    o_handle = create_temp(out_path)
+    o_handle.close()
+    try:
+        with job.profiled('gpx', True):
+            gpx_out = subprocess.check_output(gpx_command(job, in_path, o_handle.name, arg_p), shell=True)
+        commit_file(o_handle.name, out_path, fsync=job.fsync)
+    except subprocess.CalledProcessError as e:
+        discard_temp(o_handle.name)
+        gpx_failed(job, e.returncode, e.output.decode(errors='replace'))
+    except OSError as e:
+        discard_temp(o_handle.name)
+        seppuku(f"FATAL: failed to write to file '{out_path}': {e}")
+    except BaseException:
+        discard_temp(o_handle.name)
+        raise
+    if gpx_out:
+        job.log(gpx_out, verbose=True)
+
+
+class GpxStream:
+    """
+    Runs GPX on a FIFO, such that G-code can be fed to it while it is still
+    being produced, and X3G encoding overlaps with post-processing. The output
+    of GPX is collected by a background thread (and printed as it arrives in
+    verbose mode), so GPX never blocks on it. Only available where os.mkfifo
+    exists.
+    """
+
+    def __init__(self, job, out_path, arg_p):
+        job.log("Invoking GPX...")
+        self.job = job
+        self.record = job.profiler.begin('gpx_stream') if job.profiler else None
+        self.fifo_dir = tempfile.mkdtemp(prefix='make_fcp_x3g_')
+        fifo = os.path.join(self.fifo_dir, 'gcode')
+        os.mkfifo(fifo)
+        self.output = []
+        self.broken = False
+        self.out_path = out_path
+        # GPX writes to a temporary file, which only replaces out_path once
+        # GPX has succeeded.
+        o_handle = create_temp(out_path)
+        o_handle.close()
+        self.tmpname = o_handle.name
+        # With exec, killing the process kills GPX instead of the shell.
+        self.proc = subprocess.Popen(f"exec {gpx_command(job, fifo, self.tmpname, arg_p)}", shell=True,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.reader = threading.Thread(target=self._collect, daemon=True)
+        self.reader.start()
+
+        # Opening a FIFO blocks until the other end is opened. Do not wait
+        # forever if GPX dies before it gets to opening it.
+        fd = None
+        while fd is None:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENXIO or self.proc.poll() is not None:
+                    self.broken = True
+                    break
+                time.sleep(0.01)
+        self.handle = None
+        if fd is not None:
+            os.set_blocking(fd, True)
+            self.handle = open(fd, 'wb', buffering=1048576)
+
+    def _collect(self):
+        for line in self.proc.stdout:
+            self.output.append(line)
+            if self.job.options.verbose:
+                print(line.decode(errors='replace'), end='')
+
+    def write(self, data):
+        if self.broken:
+            return
+        try:
+            self.handle.write(data)
+        except BrokenPipeError:
+            # GPX has stopped reading, its exit status will tell why.
+            self.broken = True
+
+    def _close(self):
+        if self.handle:
+            try:
+                self.handle.close()
+            except BrokenPipeError:
+                self.broken = True
+            self.handle = None
+        self.proc.wait()
+        self.reader.join()
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+        if self.record:
+            self.job.profiler.end(self.record, True)
+            self.record = None
+
+    def abort(self):
+        """Stops GPX, and removes what it may have written."""
+        self.broken = True
+        self.proc.kill()
+        self._close()
+        discard_temp(self.tmpname)
+
+    def finish(self):
+        """
+        Waits for GPX to finish, and puts its result in place, or aborts with a
+        FAIL file if it failed.
+        """
+        self._close()
+        if self.proc.returncode or self.broken:
+            discard_temp(self.tmpname)
+            gpx_failed(self.job, self.proc.returncode, b''.join(self.output).decode(errors='replace'))
+        try:
+            commit_file(self.tmpname, self.out_path, fsync=self.job.fsync)
+        except OSError as e:
+            discard_temp(self.tmpname)
+            seppuku(f"FATAL: failed to write to file '{self.out_path}': {e}")
+
+
+# With GPX_JOBS above 1, the G-code is split into parts at layer changes like
+# for PARALLEL SCAN, and that many GPX processes convert the parts at once.
+# Every part but the first starts with a preamble that puts GPX in the state
+# it would have been in at that point, and every part but the last ends with
+# an extra dwell. These show up as delays in the X3G output of each part, at
+# which the preamble and the extra dwell are cut off before the parts are
+# joined. GPX cannot calculate build progress (-p) this way.
+
+# Dwell times in milliseconds that mark where a part really starts and ends.
+GPX_PART_START = 1117
+GPX_PART_END = 1119
+
+
+def line_start_before(buf, prefix, end):
+    """Returns the offset of the last line before end in buf that starts with prefix, or -1."""
+    pos = buf.rfind(b'\n' + prefix, 0, end)
+    if pos >= 0:
+        return pos + 1
+    return 0 if buf[:len(prefix)] == prefix and end > 0 else -1
+
+
+def gpx_preamble(buf, start):
+    """
+    Returns the G-code that brings GPX in the state of the machine at offset
+    start of buf, where positioning must be absolute: the active tool, the
+    last temperatures set, the position, the E mode and the feedrate.
+    """
+    lines = []
+    tools = {tool: line_start_before(buf, tool, start) for tool in (b'T0', b'T1')}
+    tool = max(tools, key=tools.get)
+    if tools[tool] >= 0:
+        lines.append(tool.decode())
+    # Only the last temperature of every tool matters. Do not wait for it.
+    heaters = {}
+    for commands, setter in (((b'M104 ', b'M109 '), 'M104'), ((b'M140 ', b'M190 '), 'M140')):
+        pos = start
+        while True:
+            pos = max(line_start_before(buf, command, pos) for command in commands)
+            if pos < 0:
+                break
+            args = buf[pos + 5:buf.find(b'\n', pos)].split(b';', 1)[0].decode(errors='replace').split()
+            key = (setter, next((arg for arg in args if arg[:1] == 'T'), None))
+            heaters.setdefault(key, f"{setter} {' '.join(args)}")
+    lines.extend(reversed(list(heaters.values())))
+    x, y, z, e, _, relative_e = motion_state(buf, start)
+    # With relative E, the last E is a distance rather than a position.
+    e = 0.0 if relative_e else e
+    lines.append(f"G90\n{'M83' if relative_e else 'M82'}\nG92 X{x!r} Y{y!r} Z{z!r} E{e!r}")
+    feedrate = last_value(buf, b'F', 0, start)
+    if feedrate is not None:
+        lines.append(f"G1 F{feedrate!r}")
+    lines.append(f"G4 P{GPX_PART_START}")
+    return ''.join(f"{line}\n" for line in lines).encode()
+
+
+def part_begin(buf):
+    """Returns the offset of the X3G output of a part after its preamble, or -1."""
+    marker = struct.pack('<BI', X3G_DELAY, GPX_PART_START)
+    pos = 0
+    while pos < len(buf):
+        end = x3g_command_end(buf, pos)
+        if end is None or end < 0:
+            return -1
+        if buf[pos:end] == marker:
+            return end
+        pos = end
+    return -1
+
+
+def part_end(buf):
+    """Returns the offset of the extra dwell at the end of the X3G output of a part, or -1."""
+    marker = struct.pack('<BI', X3G_DELAY, GPX_PART_END)
+    pos = len(buf)
+    while True:
+        pos = buf.rfind(marker, 0, pos)
+        if pos < 0:
+            return -1
+        # The marker must be an actual command, right at the end.
+        if x3g_command_end(buf, pos) == len(buf):
+            return pos
+
+
+def run_gpx_parallel(job, in_path, out_path, jobs):
+    """
+    Converts in_path to out_path with up to jobs GPX processes at once.
+    Returns False if the file cannot be split, or the parts cannot be joined,
+    such that it must be converted in one go instead.
+    """
+    with open(in_path, 'rb') as f_handle, mmap.mmap(f_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        # Only a layer change is sure to be a point where GPX can pick up.
+        ranges = split_ranges(buf, jobs, layers_only=True)
+        if len(ranges) < 2:
+            job.log("No layer changes found to split at, converting in one go.")
+            return False
+        job.log(f"Invoking {len(ranges)} GPX processes...")
+        work_dir = tempfile.mkdtemp(prefix='.make_fcp_x3g_', dir=os.path.dirname(os.path.abspath(out_path)))
+        try:
+            parts = []
+            for n, (start, end) in enumerate(ranges):
+                part = os.path.join(work_dir, f"part{n}")
+                with open(f"{part}.gcode", 'wb') as o_handle:
+                    if start:
+                        o_handle.write(gpx_preamble(buf, start))
+                    for pos in range(start, end, PIPE_SIZE):
+                        o_handle.write(buf[pos:min(pos + PIPE_SIZE, end)])
+                    if end < len(buf):
+                        o_handle.write(f"G4 P{GPX_PART_END}\n".encode())
+                parts.append(part)
+            return join_gpx_parts(job, parts, out_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def join_gpx_parts(job, parts, out_path):
+    """Runs GPX on all parts at once, and joins their X3G output into out_path."""
+    procs = []
+    for part in parts:
+        with open(f"{part}.log", 'wb') as log_handle:
+            procs.append(subprocess.Popen(gpx_command(job, f"{part}.gcode", f"{part}.x3g", ''), shell=True,
+                                          stdout=log_handle, stderr=subprocess.STDOUT))
+    for proc in procs:
+        proc.wait()
+    gpx_out = ''
+    for part in parts:
+        with open(f"{part}.log", 'rb') as i_handle:
+            gpx_out += i_handle.read().decode(errors='replace')
+    failed = next((proc.returncode for proc in procs if proc.returncode), 0)
+    if failed:
+        gpx_failed(job, failed, gpx_out)
+    if gpx_out:
+        job.log(gpx_out, verbose=True)
+
+    o_handle = create_temp(out_path)
+    try:
+        with o_handle:
+            for n, part in enumerate(parts):
+                with open(f"{part}.x3g", 'rb') as i_handle:
+                    size = os.fstat(i_handle.fileno()).st_size
+                    if not size:
+                        raise ValueError(f"no output for part {n}")
+                    with mmap.mmap(i_handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        begin = part_begin(buf) if n else 0
+                        end = part_end(buf) if n < len(parts) - 1 else size
+                        if begin < 0 or end < begin:
+                            raise ValueError(f"markers not found in part {n}")
+                        for pos in range(begin, end, PIPE_SIZE):
+                            o_handle.write(buf[pos:min(pos + PIPE_SIZE, end)])
+        commit_file(o_handle.name, out_path, fsync=job.fsync)
+    except ValueError as e:
+        discard_temp(o_handle.name)
+        job.log(f"Cannot join the output of the GPX processes ({e}), converting in one go instead.")
+        return False
+    except IOError as e:
+        discard_temp(o_handle.name)
+        seppuku(f"FATAL: failed to write to file '{out_path}': {e}")
+    return True
+
+
+def first_difference(path_a, path_b):
+    """Returns the offset of the first byte in which two files differ, or None if they are equal."""
+    offset = 0
+    with open(path_a, 'rb') as a_handle, open(path_b, 'rb') as b_handle:
+        while True:
+            a_chunk = a_handle.read(PIPE_SIZE)
+            b_chunk = b_handle.read(PIPE_SIZE)
+            if a_chunk != b_chunk:
+                return offset + next((n for n, (a, b) in enumerate(zip(a_chunk, b_chunk)) if a != b),
+                                     min(len(a_chunk), len(b_chunk)))
+            if not a_chunk:
+                return None
+            offset += len(a_chunk)
+
+
+def verify_gpx(job, in_path):
+    """
+    Converts in_path once more with a single GPX process, and compares the
+    result with the X3G file converted in parallel. If they differ, that is
+    reported and the result of the single process is kept.
+    """
+    o_handle = create_temp(job.x3g_file)
+    o_handle.close()
+    try:
+        run_gpx(job, in_path, o_handle.name, '')
+        offset = first_difference(job.x3g_file, o_handle.name)
+        if offset is None:
+            job.log("Parallel GPX conversion verified: identical to converting in one go.")
+            return
+        job.append_warning(f"WARNING: parallel GPX conversion differs from converting in one go from byte {offset} "
+                           f"onwards. The X3G file was converted in one go instead; please report this.")
+        commit_file(o_handle.name, job.x3g_file, fsync=job.fsync)
+    finally:
+        discard_temp(o_handle.name)
+
+
+def convert_gpx(job, in_path, arg_p):
+    """Runs GPX on in_path, in parallel if GPX_JOBS (or --gpx-jobs) asks for it."""
+    # Batch workers already keep all cores busy.
+    if job.gpx_jobs > 1 and worker_config is None:
+        if arg_p:
+            job.log("Not running GPX in parallel, because it must calculate build progress (-p). Use -e instead.")
+        else:
+            with job.profiled('gpx_parallel', True):
+                converted = run_gpx_parallel(job, in_path, job.x3g_file, job.gpx_jobs)
+            if converted:
+                if job.options.verify_gpx:
+                    verify_gpx(job, in_path)
+                return
+    run_gpx(job, in_path, job.x3g_file, arg_p)
+
+
+# SCRIPT CHAINING ####
+#
+# Processing a file runs a chain of elements, in this order: the final Z fix,
+# DUALSTRUDE_SCRIPT, the M104 and M83 fixes, RETRACT_SCRIPT and PWM_SCRIPT.
+# Each element is either a list of stages, or a (name, command) tuple for an
+# external script. Where the OS allows it, all elements run at the same time,
+# connected by pipes: scripts get /dev/fd/N paths for their input and -o
+# output, and each list of stages runs in its own thread. Otherwise, they run
+# one after the other on the file.
+
+# Buffer size of the pipes, and of reading and writing them.
+PIPE_SIZE = 1048576
+
+
+def pipes_usable(config):
+    return config_flag(config.PIPE_SCRIPTS) and os.name == 'posix' and os.path.isdir('/dev/fd')
+
+
+def make_pipe():
+    """Returns the read and write ends of a new pipe, enlarged where possible."""
+    r_fd, w_fd = os.pipe()
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(w_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            # Beyond the limit for unprivileged users.
+            pass
+    return r_fd, w_fd
+
+
+class ScriptProcess:
+    """
+    Runs a post-processing script that reads its input from the pipe in_fd and
+    writes its output to the pipe out_fd, and collects what it prints.
+    """
+
+    def __init__(self, job, name, cmd, in_fd, out_fd):
+        job.log(f"Running {name} script...")
+        self.job = job
+        self.name = name
+        cmd = f"{' '.join(map(shell_escape, cmd))} -o /dev/fd/{out_fd} /dev/fd/{in_fd}"
+        job.log(f"Executing: {cmd}", verbose=True)
+        self.record = job.profiler.begin(f"script:{name}") if job.profiler else None
+        # With exec, killing the process kills the script instead of the shell.
+        self.proc = subprocess.Popen(f"exec {cmd}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     pass_fds=(in_fd, out_fd))
+        self.printed = b''
+        self.output = ''
+        self.reader = threading.Thread(target=self._collect, daemon=True)
+        self.reader.start()
+
+    def _collect(self):
+        self.printed = self.proc.stdout.read()
+
+    def wait(self):
+        """Waits for the script to finish, and sets output to what it printed."""
+        self.proc.wait()
+        self.reader.join()
+        self.output = self.printed.decode(errors='replace')
+        if self.record:
+            self.job.profiler.end(self.record, True)
+            self.record = None
+
+
+def broken_pipe(script):
+    """
+    Tells whether a failed script was stopped by writing to a pipe that nobody
+    reads anymore: killed by SIGPIPE (which a shell script reports as 128 +
+    SIGPIPE), or failing with EPIPE.
+    """
+    sigpipe = getattr(signal, 'SIGPIPE', None)
+    if sigpipe and script.proc.returncode in (-sigpipe, 128 + sigpipe):
+        return True
+    return os.strerror(errno.EPIPE) in script.output
+
+
+def pump_segment(lines, stages, ctx, i_handle, o_handle, errors):
+    """Does pump_lines in a thread of a piped chain, and closes both handles."""
+    try:
+        with o_handle:
+            pump_lines(lines, stages, ctx, o_handle)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if i_handle:
+            i_handle.close()
+
+
+def process_chain(job, in_path, chain, ctx, gpx=None, piped=False, compression=None, out_path=None,
+                  out_compression=None):
+    """
+    Runs chain over in_path, and replaces in_path, or out_path if given, with
+    the result. If gpx is a GpxStream, the result is fed to it while it is
+    being produced, which is only possible when piped or when the chain ends
+    with a list of stages. If compression or out_compression are given, the
+    chain must start and end with a list of stages, which decompress the input
+    and compress the result.
+    """
+    out_path = out_path or in_path
+    if not piped:
+        # Scripts run in place on a plain file, the result itself if possible.
+        work = None if out_compression else out_path
+        try:
+            for n, element in enumerate(chain):
+                last = n == len(chain) - 1
+                source = in_path if n == 0 else work
+                if last:
+                    target, target_compression = out_path, out_compression
+                else:
+                    if work is None:
+                        with create_temp(out_path) as o_handle:
+                            work = o_handle.name
+                    target, target_compression = work, None
+                if element.__class__ is list:
+                    process_gcode(source, element, ctx, gpx if last else None, job.fsync,
+                                  compression if n == 0 else None, target, target_compression)
+                else:
+                    run_script(job, element[0], source, element[1])
+        finally:
+            if work not in (None, out_path):
+                discard_temp(work)
+        return
+
+    # Lists of stages read the input and write the output.
+    if chain[0].__class__ is not list:
+        chain = [[]] + chain
+    if chain[-1].__class__ is not list:
+        chain = chain + [[]]
+
+    o_handle = create_temp(out_path)
+    tmpname = o_handle.name
+    scripts = []
+    threads = []
+    errors = []
+    try:
+        with o_handle, open_gcode(in_path, compression) as i_handle, \
+                compressed_writer(o_handle, out_compression) as c_handle:
+            source = None
+            s_handle = None
+            try:
+                # Every element but the last is started in the background.
+                for element in chain[:-1]:
+                    if element.__class__ is list:
+                        lines = i_handle
+                        r_handle = None
+                        if source is not None:
+                            lines = r_handle = open(source, 'rb', buffering=PIPE_SIZE)
+                        source, sink = make_pipe()
+                        sink = open(sink, 'wb', buffering=PIPE_SIZE)
+                        thread = threading.Thread(target=pump_segment, args=(lines, element, ctx, r_handle, sink, errors))
+                        thread.start()
+                        threads.append(thread)
+                    else:
+                        out_r, out_w = make_pipe()
+                        try:
+                            scripts.append(ScriptProcess(job, element[0], element[1], source, out_w))
+                        finally:
+                            os.close(source)
+                            os.close(out_w)
+                        source = out_r
+                s_handle = open(source, 'rb', buffering=PIPE_SIZE)
+                pump_lines(s_handle, chain[-1], ctx, TeeWriter(c_handle, gpx) if gpx else c_handle)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if s_handle:
+                    s_handle.close()
+                for script in scripts:
+                    if errors:
+                        script.proc.kill()
+                    script.wait()
+                for thread in threads:
+                    thread.join()
+    except IOError as e:
+        errors.append(e)
+
+    failed = [script for script in scripts if script.proc.returncode]
+    if failed or errors:
+        discard_temp(tmpname)
+        if gpx:
+            gpx.abort()
+    if failed:
+        with open(job.fail_file, 'a') as f_handle:
+            for script in failed:
+                print(script.output or f"The {script.name} script failed ({script.proc.returncode}), but without any output.", file=f_handle)
+        # Scripts fail when a script after them stops reading, but not the
+        # other way around.
+        culprit = failed[-1]
+        hint = " It was stopped by a later script that quit reading its input." if broken_pipe(culprit) else ''
+        fatality(1, f"FATAL: running {culprit.name} script failed, aborting postprocessing.{hint}")
+    for e in errors:
+        if e.__class__ is not BrokenPipeError:
+            fatality(1, f"FATAL: failed to process '{in_path}': {e}")
+    if errors:
+        fatality(1, "FATAL: a post-processing script stopped reading its input before the end, aborting postprocessing.")
+
+    try:
+        commit_file(tmpname, out_path, mode_from=in_path, fsync=job.fsync)
+    except OSError as e:
+        discard_temp(tmpname)
+        fatality(1, f"FATAL: failed to process '{in_path}': {e}")
+    for script in scripts:
+        if script.output:
+            job.append_warning(script.output)
+
+
+# RESULT CACHE ####
+#
+# Results are stored in CACHE_DIR/xx/<key>/, where <key> is a hash of
+# everything that determines them. Each entry holds the processed G-code
+# ('gcode'), the X3G file if GPX was run ('x3g'), and any warnings
+# ('warnings'). The modification time of an entry is its last use.
+
+def result_cache_key(job):
+    """
+    Returns a hash of the contents of the input file, the effective
+    configuration and options, and the identities of GPX and the
+    post-processing scripts.
+    """
+    config, options = job.config, job.options
+    # The first element of a script is its command.
+    commands = [[config.GPX], config.DUALSTRUDE_SCRIPT, config.PWM_SCRIPT, config.RETRACT_SCRIPT]
+    settings = (VERSION, config.FINAL_Z_MOVE, str(config.X_MAX), str(config.Y_MAX), str(config.Z_MAX),
+                str(config.FIRST_LAYER_MAX), config.MACHINE, config.DUALSTRUDE_SCRIPT,
+                config.PWM_SCRIPT, config.RETRACT_SCRIPT, options.no_postproc, options.force_progress,
+                options.stream_gpx, job.estimate_progress, bool(gpx_usable(config)), job.gcode_compression,
+                [file_identity(path, n == 0) for command in commands for n, path in enumerate(command) if path])
+    digest = hashlib.sha256(repr(settings).encode())
+    try:
+        with open(job.inputfile, 'rb') as i_handle:
+            while True:
+                chunk = i_handle.read(1048576)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except IOError as e:
+        seppuku(f"FATAL: failed to read input file '{job.inputfile}': {e}")
+    return digest.hexdigest()
+
+
+def cache_entry(config, key):
+    return os.path.join(config.CACHE_DIR, key[:2], key)
+
+
+def cache_restore(job, key):
+    """
+    If the cache has an entry for key, puts its files in place of the ones that
+    processing the input file would produce, and returns True.
+    """
+    entry = cache_entry(job.config, key)
+    if not os.path.isfile(os.path.join(entry, 'gcode')):
+        return False
+    if gpx_usable(job.config) and not os.path.isfile(os.path.join(entry, 'x3g')):
+        return False
+    job.log("Using cached result")
+    os.utime(entry)
+    if job.keep_orig and job.gcode_file == job.inputfile:
+        backup_file(job.inputfile, job.origfile, job.fsync)
+
+    copy_file('cached', os.path.join(entry, 'gcode'), job.gcode_file, job.fsync, mode_from=job.inputfile)
+    if os.path.isfile(os.path.join(entry, 'x3g')):
+        copy_file('cached', os.path.join(entry, 'x3g'), job.x3g_file, job.fsync)
+    if os.path.isfile(os.path.join(entry, 'warnings')):
+        with open(os.path.join(entry, 'warnings'), 'r') as w_handle:
+            job.append_warning(w_handle.read().rstrip('\n'))
+    return True
+
+
+def cache_store(job, key):
+    """Stores the results of processing the input file, and evicts old entries."""
+    config = job.config
+    entry = cache_entry(config, key)
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp')
+        # Not hard links, because the input file may be modified in place.
+        copy_file('result', job.gcode_file, os.path.join(tmp_entry, 'gcode'))
+        if gpx_usable(config) and os.path.isfile(job.x3g_file):
+            copy_file('X3G', job.x3g_file, os.path.join(tmp_entry, 'x3g'))
+        if os.path.isfile(job.warn_file):
+            copy_file('warnings', job.warn_file, os.path.join(tmp_entry, 'warnings'))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Someone else stored the same result in the meantime.
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        cache_evict(job, int(config.CACHE_SIZE) * 1048576)
+    except (OSError, ValueError, ProcessingError) as e:
+        print(f"Could not store result in cache '{config.CACHE_DIR}': {e}", file=sys.stderr)
+
+
+def cache_evict(job, max_size):
+    """Removes the least recently used entries until the cache fits in max_size bytes."""
+    entries = []
+    total = 0
+    for entry in glob.glob(os.path.join(glob.escape(job.config.CACHE_DIR), '??', '*')):
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError:
+            continue
+        total += size
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        job.log(f"Evicting cache entry {os.path.basename(entry)}", verbose=True)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def cache_purge(config):
+    if not config.CACHE_DIR:
+        print("No CACHE_DIR configured, nothing to purge.")
+        return
+    print(f"Purging cache '{config.CACHE_DIR}'")
+    for entry in glob.glob(os.path.join(glob.escape(config.CACHE_DIR), '??')):
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+# JOBS ####
+
+class Job:
+    """
+    A G-code file to be processed with a Config and Options, and the paths of
+    all files derived from it. If output_name is given, it takes the role of
+    SLIC3R_PP_OUTPUT_NAME: the X3G file and all additional files are based on
+    that path instead of the input path.
+    The processed G-code goes to gcode_file with gcode_compression. This is
+    the input file itself, except for compressed input that must not be
+    compressed again, which is processed into a plain file next to it.
+    After running, warnings holds everything written to the WARN file, and
+    cached tells whether the result was taken from the cache.
+    """
+
+    def __init__(self, path, config, options=None, output_name=None):
+        options = options or Options()
+        self.config = config
+        self.options = options
+        self.keep_orig = options.keep_orig or config_flag(config.KEEP_ORIG)
+        self.fsync = config_flag(config.FSYNC)
+        self.compress = options.compress or config_flag(config.COMPRESS)
+        self.estimate_progress = options.estimate_progress or config_flag(config.ESTIMATE_PROGRESS)
+        self.gpx_jobs = int(config_number(config, 'GPX_JOBS')) if options.gpx_jobs is None else options.gpx_jobs
+        self.debug = options.debug or config_flag(config.DEBUG)
+        self.warnings = []
+        self.cached = False
+        self.profiler = None
+
+        inputfile = path if path and len(path) > 1 else None
+        if options.wsl and inputfile:
+            # Although the conversion between Windows and Linux paths seems trivial, it
+            # has many quirks so it is better to rely on the dedicated wslpath tool.
+            self.log(f"Converting incoming Windows path '{inputfile}' to UNIX path", verbose=True)
+            try:
+                inputfile = subprocess.check_output(f'wslpath -a {shell_escape(inputfile)}', shell=True).decode().strip()
+            except subprocess.CalledProcessError:
+                inputfile = ''
+            if inputfile == '':
+                seppuku("FATAL: 'wslpath' command not found or failed")
+            self.log(f"Converted Windows path to WSL path: '{inputfile}'")
+        self.inputfile = inputfile
+
+        self.compression = compression_of(inputfile) if inputfile else None
+        if self.compression and not self.compress and not options.no_postproc:
+            self.gcode_file, self.gcode_compression = strip_compression(inputfile), None
+        else:
+            self.gcode_file, self.gcode_compression = inputfile, self.compression
+
+        # In case of WSL, the input path must already be converted to a Linux path.
+        self.outputfile = inputfile if output_name is None else output_name
+
+        out_base = self.outputfile
+        if out_base is not None:
+            out_base = os.path.splitext(strip_compression(out_base))[0]
+
+        # A backup of compressed input is just as compressed.
+        orig_ext = inputfile[len(strip_compression(inputfile)):] if self.compression else ''
+        self.origfile = f"{out_base}_orig.gcode{orig_ext}" if out_base is not None else None
+        # Avoid making a possibly invisible file
+        out_base = 'make_fcp_x3g' if out_base == '' else out_base
+        self.warn_file = f"{out_base}.WARN.txt" if out_base is not None else None
+        self.fail_file = f"{out_base}.FAIL.txt" if out_base is not None else None
+        self.profile_file = f"{out_base}.PROFILE.json" if out_base is not None else None
+        self.x3g_file = strip_compression(self.outputfile).rsplit('.gcode', 1)[0] + '.x3g' if self.outputfile else None
+
+    def log(self, msg, verbose=False):
+        """Prints msg unless quiet, or if verbose, only in verbose mode."""
+        if self.options.verbose if verbose else not self.options.quiet:
+            print(msg)
+
+    def clean(self):
+        """Removes any WARN or FAIL files left over from a previous run."""
+        for path in (self.warn_file, self.fail_file):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def append_warning(self, msg):
+        self.log(f"Appending warnings:\n{msg}", verbose=True)
+        self.warnings.append(msg)
+        try:
+            with open(self.warn_file, 'a') as fh:
+                print(f"{msg}", file=fh)
+        except IOError:
+            seppuku(f"FATAL: cannot write to {self.warn_file}: {sys.exc_info()[1]}")
+
+    def fail(self, msg):
+        """In debug mode, writes msg to the FAIL file."""
+        if self.debug and self.fail_file:
+            try:
+                with open(self.fail_file, 'a') as f_handle:
+                    print(msg, file=f_handle)
+            except IOError:
+                pass
+
+    def profiled(self, name, runs_subprocess=False):
+        return self.profiler.stage(name, runs_subprocess) if self.profiler else NOT_PROFILED
+
+    def run(self):
+        """
+        Post-processes the input file and converts it with GPX, profiling it if
+        requested. Returns the job itself.
+        """
+        extend_path(self.config.EXTRA_PATH)
+        self.profiler = Profiler(self.profile_file, self.inputfile) if self.options.profile else None
+        try:
+            convert_file(self)
+        except ProcessingError as e:
+            self.fail(str(e))
+            raise
+        finally:
+            if self.profiler:
+                self.profiler.write()
+                self.profiler = None
+        return self
+
+
+def process(path, config, options=None, output_name=None):
+    """
+    Processes the G-code file at path in place, like the command line script
+    does, and returns the Job. Raises ProcessingError if this fails.
+    """
+    job = Job(path, config, options, output_name)
+    job.clean()
+    return job.run()
+
+
+def convert_file(job):
+    config, options = job.config, job.options
+    inputfile = job.inputfile
+    if not inputfile or not os.path.isfile(inputfile):
+        fatality(2, f"ERROR: input file not found or is not a file: {inputfile}")
+    if not os.access(inputfile, os.R_OK):
+        fatality(2, f"ERROR: input file not readable, maybe insufficient permissions: {inputfile}")
+
+    # -p in GPX overrides % display with something that better approximates total
+    # print time than merely mapping the Z coordinate to a percentage. It still is
+    # not perfect but at least gives a sensible ballpark figure. For this to work
+    # properly, cargo cult folklore says that the start GCode block must end with
+    # "M73 P1 ;@body", although a peek in GPX source code reveals that either
+    # "M73 P1" or @body will work.
+    # With ESTIMATE_PROGRESS, M73 commands with estimated progress are inserted
+    # at every layer change instead, which GPX passes on as they are without -p.
+
+    arg_p = '-p' if options.force_progress else ''
+    gpx = None
+
+    cache_key = None
+    if config.CACHE_DIR and options.use_cache:
+        with job.profiled('cache_lookup'):
+            cache_key = result_cache_key(job)
+            if cache_restore(job, cache_key):
+                job.cached = True
+                return
+
+    if not options.no_postproc:
+        arg_p = '-p'
+
+        ctx = new_context(bool(config.DUALSTRUDE_SCRIPT and postproc_script_valid(job, config.DUALSTRUDE_SCRIPT)))
+        # Compressed input is scanned up front as well: found while it is
+        # processed, a missing marker would only be known at the end, and
+        # everything after the first line depending on it would be held back
+        # until then.
+        with job.profiled('scan_markers'):
+            flags = scan_markers(inputfile) if not job.compression else None
+            if flags is None:
+                # Cannot be memory-mapped (e.g. because it is empty or compressed).
+                flags = read_markers(inputfile, job.compression)
+        ctx.update(flags, scanned=True)
+
+        if fix_m104_decided(ctx):
+            job.log("Fixing incorrect M104 command for single-extrusion setup")
+        if ctx['m83_seen']:
+            job.log("Ensuring correct display in gcode.ws")
+        # Compressed input is checked while it is processed.
+        ranges = scan_ranges(job, inputfile) if not job.compression else None
+        if not job.compression:
+            with job.profiled('check_moves'):
+                check_file_moves(job, inputfile, ranges)
+        if job.estimate_progress:
+            if not ranges and not job.compression:
+                ranges = scan_ranges(job, inputfile, ESTIMATE_COST)
+            with job.profiled('estimate_progress'):
+                if estimate_progress(job, inputfile, ctx, ranges) and not options.force_progress:
+                    arg_p = ''
+
+        chain = []
+        if ctx['dualstrude'] and ctx['dual_ok']:
+            chain.append(('dualstrusion', config.DUALSTRUDE_SCRIPT))
+        chain.append([fix_m104, inject_m83] if fix_m104_decided(ctx) or ctx['m83_seen'] else [])
+        if postproc_script_valid(job, config.RETRACT_SCRIPT):
+            chain.append(('retraction', config.RETRACT_SCRIPT))
+        if postproc_script_valid(job, config.PWM_SCRIPT):
+            chain.append(('fan PWM post-processing', config.PWM_SCRIPT))
+
+        if job.keep_orig and job.gcode_file == inputfile:
+            # The input is only ever replaced from here on, hence a hard link
+            # suffices.
+            with job.profiled('keep_orig'):
+                backup_file(inputfile, job.origfile, job.fsync)
+        if chain == [[]] and not job.compression and not ctx['patches']:
+            # Nothing to rewrite, only the final Z move may need patching.
+            if config.FINAL_Z_MOVE:
+                with job.profiled('adjust_final_z'):
+                    adjust_final_z(job, inputfile)
+        else:
+            if job.compression:
+                # Compressed input can neither be memory-mapped nor read from
+                # the end, hence it is checked while it streams by.
+                ctx.update(config=config, warn=job.append_warning, final_z_move=config.FINAL_Z_MOVE, z_max=None)
+                if chain[0].__class__ is not list:
+                    chain.insert(0, [])
+                chain[0][:0] = [check_moves] + ([track_final_z] if config.FINAL_Z_MOVE else [])
+            elif config.FINAL_Z_MOVE:
+                try:
+                    with job.profiled('find_final_z'), open(inputfile, 'rb') as f_handle:
+                        final = find_final_z(job, f_handle)
+                except IOError as e:
+                    seppuku(f"FATAL: cannot open '{inputfile}' for reading: {e}")
+                if final:
+                    ctx['patches'][final[0]] = (final[1][0], final[2])
+            if ctx['patches']:
+                if chain[0].__class__ is list:
+                    chain[0].insert(0, patch_lines)
+                else:
+                    chain.insert(0, [patch_lines])
+            chain = [element for element in chain if element]
+            if job.compression:
+                # Only stages can decompress the input and compress the result.
+                if not chain or chain[0].__class__ is not list:
+                    chain.insert(0, [])
+                if chain[-1].__class__ is not list:
+                    chain.append([])
+            piped = pipes_usable(config) and any(element.__class__ is tuple for element in chain)
+            if options.stream_gpx and gpx_usable(config) and hasattr(os, 'mkfifo') and (piped or chain[-1].__class__ is list):
+                # GPX cannot calculate build progress on a stream.
+                arg_p = ''
+                gpx = GpxStream(job, job.x3g_file, arg_p)
+            try:
+                with job.profiled('rewrite'):
+                    process_chain(job, inputfile, chain, ctx, gpx, piped, job.compression, job.gcode_file,
+                                  job.gcode_compression)
+            except BaseException:
+                if gpx:
+                    gpx.abort()
+                raise
+
+    if gpx:
+        gpx.finish()
+    elif gpx_usable(config) and job.gcode_compression:
+        # GPX needs a plain file it can rewind, to calculate build progress.
+        plain = decompress_file(job.gcode_file, job.gcode_compression)
+        try:
+            convert_gpx(job, plain, arg_p)
+        finally:
+            discard_temp(plain)
+    elif gpx_usable(config):
+        convert_gpx(job, job.gcode_file, arg_p)
+
+    if gpx or gpx_usable(config):
+        with job.profiled('inspect_x3g'):
+            inspect_x3g(job, job.x3g_file)
+
+    if cache_key:
+        with job.profiled('cache_store'):
+            cache_store(job, cache_key)
+
+
+# BATCH MODE ####
+
+# The config and options of the batch, set in each worker process.
+worker_config = None
+worker_options = None
+
+
+def init_worker(config, options):
+    global worker_config, worker_options
+    worker_config = config
+    worker_options = options
+    # Ctrl+C and SIGTERM reach all processes at once. Only the main process
+    # handles them, by letting the running jobs finish and starting no more.
+    # GPX and the scripts run by a worker inherit this.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def batch_worker(path):
+    """
+    Processes a single file inside a batch worker process. Returns the path,
+    a status string, the wall time in seconds, and an error message if any.
+    """
+    start = time.time()
+    status, error = 'OK', ''
+    job = None
+    try:
+        job = Job(path, worker_config, worker_options)
+        job.clean()
+        job.run()
+    except ProcessingError as e:
+        status, error = f"FAIL({e.code})", f"see {job.fail_file}" if job and job.debug else str(e)
+    except Exception as e:
+        status, error = 'FAIL', str(e)
+        if job and job.fail_file:
+            try:
+                with open(job.fail_file, 'a') as f_handle:
+                    print(f"FATAL: {e}", file=f_handle)
+            except IOError:
+                pass
+    if status == 'OK' and job.warnings:
+        status, error = 'WARN', f"see {job.warn_file}"
+    sys.stdout.flush()
+    return path, status, time.time() - start, error
+
+
+def expand_inputs(patterns):
+    """
+    Expands the inputfile arguments into a list of files. Directories yield
+    all .gcode files directly inside them except _orig.gcode backups, glob
+    patterns are expanded also in shells that do not do this themselves.
+    Existing files are taken as they are, even if their name looks like a
+    pattern (e.g. 'plate[1].gcode').
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths += sorted(p for p in glob.glob(os.path.join(glob.escape(pattern), '*.gcode')) if not p.endswith('_orig.gcode'))
+        elif glob.has_magic(pattern) and not os.path.exists(pattern):
+            paths += sorted(glob.glob(pattern))
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(paths))
+
+
+def run_batch(paths, config, options, jobs):
+    """
+    Processes all paths in a pool of at most jobs worker processes, and prints
+    a summary. When interrupted, the files being processed are finished, and
+    the others skipped. Returns the number of files that failed or were
+    skipped.
+    """
+    start = time.time()
+    workers = max(1, min(jobs, len(paths)))
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                  initargs=(config, options))
+    # Files are only handed to the pool when a worker is free, such that
+    # none are queued up to start after an interruption.
+    queue = deque(paths)
+    running = set()
+    finished = set()
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                running.add(pool.submit(batch_worker, queue.popleft()))
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished |= done
+    except KeyboardInterrupt:
+        print("\nInterrupted, waiting for the files being processed...")
+    finally:
+        pool.shutdown(wait=True)
+    order = {path: n for n, path in enumerate(paths)}
+    results = sorted((future.result() for future in finished | running), key=lambda result: order[result[0]])
+
+    failed = sum(1 for result in results if result[1].startswith('FAIL'))
+    skipped = len(paths) - len(results)
+    print(f"\nBatch summary: {len(results)} file(s), {failed} failed, {time.time() - start:.2f}s wall time"
+          + (f", {skipped} not processed" if skipped else ''))
+    for path, status, seconds, error in results:
+        print(f"  {status:8} {seconds:8.2f}s  {path}" + (f"  ({error})" if error else ''))
+    return failed + skipped
+
+
+# WATCH MODE ####
+#
+# With --watch, the script keeps running and processes every .gcode file that
+# appears in a directory, in a pool of worker processes that keep the config
+# loaded. The directory is rescanned every interval, which also works on
+# network shares. Where inotify is available, files are picked up as soon as
+# the program writing them closes them; otherwise a file is only considered
+# complete once it has not changed for WATCH_SETTLE seconds.
+
+WATCH_SETTLE = 2.0
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+
+
+class Inotify:
+    """
+    Watches a directory with inotify, through ctypes. Raises OSError where
+    inotify is not available.
+    """
+
+    def __init__(self, directory, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"cannot watch '{directory}'")
+
+    def read(self, timeout, wakeup_fd):
+        """
+        Waits up to timeout seconds for events, or until something can be read
+        from wakeup_fd, and returns the file names the events concern.
+        """
+        names = []
+        ready = select.select([self.fd, wakeup_fd], [], [], timeout)[0]
+        if wakeup_fd in ready:
+            os.read(wakeup_fd, 4096)
+        if self.fd not in ready:
+            return names
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        pos = 0
+        while pos + 16 <= len(data):
+            length = struct.unpack_from('iIII', data, pos)[3]
+            names.append(os.fsdecode(data[pos + 16:pos + 16 + length].rstrip(b'\0')))
+            pos += 16 + length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def file_state(path):
+    """Returns what tells whether a file has changed, or None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class Watcher:
+    """
+    Processes new .gcode files in directory in a pool of at most jobs worker
+    processes, and writes the status counters to status_file whenever they
+    change. Files that are already in the directory when the watcher starts,
+    and files it has processed itself, are left alone until they change.
+    """
+
+    def __init__(self, directory, config, options, jobs, interval=1.0, status_file=None):
+        self.directory = directory
+        self.interval = interval
+        self.status_file = status_file
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs), initializer=init_worker,
+                                                           initargs=(config, options))
+        # Files waiting to be complete: path -> (time first seen, state, time of last change).
+        self.pending = {}
+        # Files closed after writing, according to inotify.
+        self.closed = set()
+        # future -> (path, time first seen)
+        self.futures = {}
+        self.done = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.status = None
+        self.start = time.time()
+        try:
+            self.inotify = Inotify(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError:
+            self.inotify = None
+        # Finished jobs interrupt the wait, such that they are reported at once.
+        self.finished = threading.Event()
+        self.wakeup = os.pipe() if self.inotify else None
+        if self.wakeup:
+            os.set_blocking(self.wakeup[1], False)
+        # Files that must not be processed again unless their state changes.
+        self.handled = dict(self.scan())
+
+    def scan(self):
+        """Yields the path and state of each .gcode file in the directory."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            print(f"Cannot scan '{self.directory}': {e}", file=sys.stderr)
+            return
+        for entry in entries:
+            # Skip backups, and the temporary files of processing in progress.
+            if not entry.name.endswith('.gcode') or entry.name.endswith('_orig.gcode') or entry.name.startswith('.'):
+                continue
+            state = file_state(entry.path)
+            if state and entry.is_file():
+                yield entry.path, state
+
+    def poll(self):
+        """Queues the files that have become complete."""
+        now = time.time()
+        busy = {path for path, _ in self.futures.values()}
+        present = set()
+        for path, state in self.scan():
+            present.add(path)
+            if path in busy or self.handled.get(path) == state:
+                continue
+            first, old_state, changed = self.pending.get(path, (now, None, now))
+            if state != old_state:
+                changed = now
+            if os.path.basename(path) in self.closed or now - changed >= WATCH_SETTLE:
+                self.pending.pop(path, None)
+                future = self.pool.submit(batch_worker, path)
+                future.add_done_callback(self._finished)
+                self.futures[future] = (path, first)
+            else:
+                self.pending[path] = (first, state, changed)
+        self.closed.clear()
+        for files in (self.pending, self.handled):
+            for path in set(files) - present:
+                del files[path]
+
+    def _finished(self, future):
+        self.finished.set()
+        if self.wakeup:
+            try:
+                os.write(self.wakeup[1], b'.')
+            except BlockingIOError:
+                # Plenty of wakeups pending already.
+                pass
+
+    def collect(self):
+        """Reports the jobs that have finished."""
+        for future in [future for future in self.futures if future.done()]:
+            path, first = self.futures.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                status, error = future.result()[1::2]
+            except Exception as e:
+                status, error = 'FAIL', str(e)
+            latency = time.time() - first
+            self.done += 1
+            self.failed += status.startswith('FAIL')
+            self.latency += latency
+            self.handled[path] = file_state(path)
+            print(f"  {status:8} {latency:8.2f}s  {path}" + (f"  ({error})" if error else ''))
+            sys.stdout.flush()
+
+    def write_status(self):
+        running = sum(1 for future in self.futures if future.running())
+        status = {
+            'directory': self.directory,
+            'inotify': self.inotify is not None,
+            'started': self.start,
+            'queue_depth': len(self.futures) - running + len(self.pending),
+            'running': running,
+            'jobs_done': self.done,
+            'jobs_failed': self.failed,
+            'average_latency_s': self.latency / self.done if self.done else None,
+        }
+        if status == self.status or not self.status_file:
+            return
+        self.status = status
+        tmpname = os.path.join(os.path.dirname(os.path.abspath(self.status_file)), '.make_fcp_x3g_status.tmp')
+        try:
+            with open(tmpname, 'w') as o_handle:
+                json.dump(status, o_handle, indent=2)
+            os.replace(tmpname, self.status_file)
+        except IOError as e:
+            print(f"Could not write status to '{self.status_file}': {e}", file=sys.stderr)
+
+    def run(self):
+        """Watches until interrupted, then waits for the running jobs."""
+        print(f"Watching '{self.directory}' " + ("with inotify" if self.inotify else f"every {self.interval}s"))
+        try:
+            while True:
+                self.poll()
+                self.collect()
+                self.write_status()
+                if self.inotify:
+                    self.closed.update(self.inotify.read(self.interval, self.wakeup[0]))
+                else:
+                    self.finished.wait(self.interval)
+                self.finished.clear()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.collect()
+            self.pending.clear()
+            self.write_status()
+            if self.inotify:
+                self.inotify.close()
+                os.close(self.wakeup[0])
+                os.close(self.wakeup[1])
+
+
+# COMMAND LINE ####
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Processes G-code file for the FFCP and optionally converts it to X3G using GPX. Input file is overwritten and the X3G file is placed next to it, unless the SLIC3R_PP_OUTPUT_NAME environment variable exists. In the latter case, all additional files will be created based on the path indicated by that variable.")
+    parser.add_argument('-f', type=str, default=DEFAULT_CONF_FILE, help="Use custom config file. By default, the script looks for a file 'make_fcp_x3g.txt' in the same directory as the script. A config file is mandatory (it may be empty though).")
+    parser.add_argument('-c', action='store_true', help='Performs a sanity check on all configured paths, and warns if they do not point to executable files. (Nothing will be processed even if other arguments are passed.)')
+    parser.add_argument('-d', action='store_true', help="Debug mode: performs the sanity check, writes its result to a file 'make_fcp_x3g_check.txt' in the same directory as the input, and then continues processing. Will try to write a FAIL file in all cases where the script aborts unexpectedly.")
+    parser.add_argument('--recheck', action='store_true', help='Ignore remembered sanity check results and check everything again. Results are otherwise only checked again when the executables or scripts involved change.')
+    parser.add_argument('-w', action='store_true', help='Converts Windows file path to a Linux path inside a WSL environment.')
+    parser.add_argument('-P', action='store_true', help='Disables all postprocessing and only runs GPX without -p option.')
+    parser.add_argument('-p', action='store_true', help='Enable -p option of GPX even if -P is used.')
+    parser.add_argument('-k', action='store_true', help='Keep copy of original file.')
+    parser.add_argument('-z', action='store_true', help='For input compressed with gzip, xz or zstd: replace it with the compressed result, instead of writing the result uncompressed next to it (i.e. print.gcode for print.gcode.gz). Compressed input is recognized automatically.')
+    parser.add_argument('-e', action='store_true', help='Estimate the print time and insert M73 commands with the build progress and remaining minutes at every layer change, instead of using the -p option of GPX. Also works with -S.')
+    parser.add_argument('-S', action='store_true', help='Stream the post-processed G-code into GPX while it is being produced, instead of running GPX afterwards. Not available in Windows, nor when post-processing scripts must run one after the other (PIPE_SCRIPTS = 0). Implies no -p option for GPX, because GPX must rewind its input to calculate build progress.')
+    parser.add_argument('--gpx-jobs', type=int, metavar='N', help='Split the G-code into N parts at layer changes and convert them with N GPX processes at once (default: GPX_JOBS from the config file). Not used with -S, nor when GPX must calculate build progress (-p), nor in batch mode.')
+    parser.add_argument('--verify-gpx', action='store_true', help='After converting with several GPX processes, convert once more with a single one and check that the X3G files are identical. If they are not, a warning is written and the result of the single process is kept.')
+    parser.add_argument('-s', type=int, help='Pause S seconds when exiting, useful for troubleshooting in Windows.')
+    parser.add_argument('-v', action='store_true', help='Verbose output.')
+    parser.add_argument('--profile', action='store_true', help='Measure wall time, CPU time, I/O and peak memory of every processing stage and subprocess, and write them to a PROFILE.json file next to the input (or SLIC3R_PP_OUTPUT_NAME).')
+    parser.add_argument('--no-cache', action='store_true', help='Do not look up nor store results in the cache configured with CACHE_DIR.')
+    parser.add_argument('--purge-cache', action='store_true', help='Empty the cache configured with CACHE_DIR before doing anything else. The input file may be omitted in this case.')
+    parser.add_argument('--watch', nargs='?', const='', metavar='DIR', help='Keep running and process every .gcode file that appears in DIR (or WATCH_DIR from the config file), once it has been completely written. Files already in DIR when starting are left alone. Up to -j files are processed at the same time, without reading the config again. Status counters are written to make_fcp_x3g.STATUS.json in DIR. Stop with Ctrl+C or SIGTERM.')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between scans of the --watch directory (default: 1).')
+    parser.add_argument('-j', type=int, default=os.cpu_count() or 1, help='Number of files to process in parallel in batch mode (default: number of CPU cores).')
+    parser.add_argument('inputfile', type=str, nargs='*', help='Input file to be processed. If multiple files, a directory or a glob pattern are given, all matching files are processed in batch mode: the configuration is read only once, and the files are processed in parallel, each with its own WARN and FAIL files. SLIC3R_PP_OUTPUT_NAME is ignored in batch mode.')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    exit_sleep = args.s
+    options = Options(keep_orig=args.k, debug=args.d, wsl=args.w, no_postproc=args.P, force_progress=args.p,
+                      stream_gpx=args.S, use_cache=not args.no_cache, recheck=args.recheck, verbose=args.v,
+                      profile=args.profile, compress=args.z, estimate_progress=args.e, gpx_jobs=args.gpx_jobs,
+                      verify_gpx=args.verify_gpx)
+
+    paths = expand_inputs(args.inputfile)
+    batch = len(args.inputfile) > 1 or paths != args.inputfile[:1]
+
+    job = None
+    try:
+        # Without a config file, configuration mistakes would go unnoticed.
+        config = read_config(args.f) if args.f else Config()
+
+        # Set up the job already, such that we can at least try to write a
+        # FAIL file if -d and something fatal happens in the early stages.
+        if not batch and args.watch is None:
+            job = Job(paths[0] if paths else None, config, options, os.environ.get('SLIC3R_PP_OUTPUT_NAME'))
+            job.clean()
+
+        if exit_sleep is not None and not re.match(r'^\d?\.?\d+$', str(exit_sleep)):
+            # Since someone is probably trying to add the -s argument to catch an
+            # error briefly flashing, sleep with a default to show this error.
+            exit_sleep = 3
+            fatality(2, "ERROR: argument following -s must be a positive number")
+
+        extend_path(config.EXTRA_PATH)
+
+        if args.purge_cache:
+            cache_purge(config)
+            if not args.inputfile:
+                do_exit(0, exit_sleep)
+
+        if args.c:
+            sanity_check(config, recheck=options.recheck, verbose=options.verbose)
+            do_exit(0, exit_sleep)
+
+        if args.watch is not None:
+            watch_dir = args.watch or config.WATCH_DIR
+            if args.inputfile:
+                fatality(2, "ERROR: no input files can be given with --watch.")
+            if not watch_dir or not os.path.isdir(watch_dir):
+                fatality(2, f"ERROR: --watch needs an existing directory, either as argument or as WATCH_DIR in the config file: {watch_dir}")
+        elif batch and not paths:
+            fatality(2, "ERROR: no input files found.")
+        elif not batch and not job.inputfile:
+            fatality(2, "ERROR: argument should be the path to a .gcode file.\nRun this script with -h for usage information.")
+
+        if options.debug or config_flag(config.DEBUG):
+            check_out = os.path.join(watch_dir if args.watch is not None else os.path.dirname(job.outputfile if not batch else paths[0]),
+                                     'make_fcp_x3g_check.txt')
+            try:
+                with open(check_out, 'w') as o_handle:
+                    sanity_check(config, o_handle, recheck=options.recheck, verbose=options.verbose)
+            except IOError:
+                seppuku(f"FATAL: cannot write to '{check_out}': {sys.exc_info()[1]}")
+    except ProcessingError as e:
+        print(e, file=sys.stderr)
+        if job:
+            job.fail(str(e))
+        do_exit(e.code, exit_sleep)
+
+    if args.watch is not None:
+        # The checks are cached, so this is quick unless something changed.
+        check_out = io.StringIO()
+        if sanity_check(config, check_out, recheck=options.recheck, verbose=options.verbose):
+            print(check_out.getvalue(), file=sys.stderr, end='')
+        # Only report one line per file, unless asked for more.
+        options.quiet = not options.verbose
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            Watcher(watch_dir, config, options, args.j, args.interval,
+                    os.path.join(watch_dir, 'make_fcp_x3g.STATUS.json')).run()
+        except KeyboardInterrupt:
+            pass
+        do_exit(0, exit_sleep)
+
+    if batch:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        do_exit(1 if run_batch(paths, config, options, args.j) else 0, exit_sleep)
+
+    try:
+        job.run()
+    except ProcessingError as e:
+        # The job has already written the FAIL file.
+        print(e, file=sys.stderr)
+        do_exit(e.code, exit_sleep)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Behavior tests for the building blocks of make_fcp_x3g.py that are hard to
+get right and easy to break: the deferred output of the streaming engine, the
+build volume check, and the X3G decoder. Run with python -m unittest or
+pytest.
+"""
+import io
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import make_fcp_x3g as mfx  # noqa: E402
+
+
+def waiting_for(ctx, key, line, resolved):
+    """Returns a Deferred for line that becomes resolved once ctx[key] is set."""
+    def resolver(line, final):
+        if ctx.get(key):
+            return resolved
+        return line if final else None
+    return mfx.Deferred(line, resolver)
+
+
+class DeferredWriterTest(unittest.TestCase):
+
+    def test_resolved_in_order_across_spill(self):
+        ctx = {}
+        out = io.BytesIO()
+        writer = mfx.DeferredWriter(out, hold_limit=64)
+        writer.write(b'first\n')
+        writer.write(waiting_for(ctx, 'go', b'a\n', b'A\n'))
+        for n in range(20):
+            writer.write(b'line %d\n' % n)
+        self.assertIsNotNone(writer.spill)
+        writer.write(waiting_for(ctx, 'go', b'b\n', b'B\n'))
+        writer.write(b'after b\n')
+        self.assertEqual(out.getvalue(), b'first\n')
+
+        ctx['go'] = True
+        writer.write(b'last\n')
+        writer.flush(final=True)
+        expected = b'first\nA\n' + b''.join(b'line %d\n' % n for n in range(20)) + b'B\nafter b\nlast\n'
+        self.assertEqual(out.getvalue(), expected)
+        self.assertIsNone(writer.spill)
+
+    def test_undecided_until_the_end(self):
+        out = io.BytesIO()
+        writer = mfx.DeferredWriter(out, hold_limit=16)
+        writer.write(waiting_for({}, 'never', b'kept\n', b'changed\n'))
+        for n in range(10):
+            writer.write(b'line %d\n' % n)
+        self.assertEqual(out.getvalue(), b'')
+        writer.flush(final=True)
+        self.assertEqual(out.getvalue(), b'kept\n' + b''.join(b'line %d\n' % n for n in range(10)))
+
+    def test_resolve_deferred(self):
+        ctx = {}
+        items = [b'x\n', waiting_for(ctx, 'go', b'a\n', b'A\n'), b'y\n']
+        self.assertEqual(b''.join(mfx.resolve_deferred(items, hold_limit=1)), b'x\na\ny\n')
+        ctx['go'] = True
+        self.assertEqual(b''.join(mfx.resolve_deferred(items, hold_limit=1)), b'x\nA\ny\n')
+
+
+class MotionCheckTest(unittest.TestCase):
+
+    def check(self, *chunks):
+        motion = mfx.MotionCheck(mfx.Config(FIRST_LAYER_MAX=0))
+        for chunk in chunks:
+            motion.feed(chunk)
+        return motion.warnings()
+
+    def test_relative_moves_out_of_bounds(self):
+        warnings = self.check(b'G90\nG1 X100 Y0 Z1\nG91\nG1 X10\nG1 X10\nG90\nG1 X0\n')
+        self.assertEqual(warnings, ["WARNING: X coordinates in this file exceed the maximum: 120 > 114 at line 5, "
+                                    "in 1 move(s). This print will likely end in disaster."])
+
+    def test_relative_moves_within_bounds(self):
+        self.assertEqual(self.check(b'G1 X100 Y70 Z1\nG91\nG1 X10 Y-140\nG1 X-10 Y70\nG90\n'), [])
+
+    def test_relative_z_below_bed(self):
+        warnings = self.check(b'G1 Z0.3\nG91\nG1 Z-1 ; lower\nG1 Z1\nG90\n')
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('below the bed in Z, down to -0.7 at line 3', warnings[0])
+
+    def test_relative_moves_across_chunks(self):
+        whole = b'G1 X100 Y0 Z1\nG91\nG1 X10\nG1 X10\nG90\n'
+        split = whole.index(b'G1 X10\nG1')
+        self.assertEqual(self.check(whole[:split], whole[split:]), self.check(whole))
+
+    def test_relative_moves_before_absolute_position(self):
+        # Without a known starting point, relative moves cannot be checked.
+        self.assertEqual(self.check(b'G91\nG1 X500\nG90\n'), [])
+
+
+def extended_move(z, relative=0):
+    return struct.pack('<B5iIBfH', mfx.X3G_EXTENDED_MOVE, 0, 0, z, 0, 0, 1000, relative, 1.0, 100)
+
+
+class X3gInspectorTest(unittest.TestCase):
+
+    def test_moves_and_highest_z(self):
+        data = bytes([mfx.X3G_CHANGE_TOOL, 0]) + extended_move(400) + extended_move(800)
+        data += extended_move(400, relative=mfx.X3G_Z_RELATIVE)
+        inspector = mfx.X3gInspector()
+        self.assertEqual(inspector.feed(data, len(data)), len(data))
+        self.assertIsNone(inspector.error)
+        self.assertEqual(inspector.counts[mfx.X3G_EXTENDED_MOVE], 3)
+        self.assertEqual(inspector.counts[mfx.X3G_CHANGE_TOOL], 1)
+        self.assertEqual(inspector.max_z, 1200)
+
+    def test_truncated_move(self):
+        data = extended_move(400) + extended_move(800)[:-3]
+        inspector = mfx.X3gInspector()
+        self.assertEqual(inspector.feed(data, len(data)), mfx.MOVE_SIZE)
+        self.assertIsNone(inspector.error)
+        self.assertEqual(inspector.counts[mfx.X3G_EXTENDED_MOVE], 1)
+        self.assertEqual(inspector.max_z, 400)
+
+    def test_truncated_string(self):
+        data = bytes([mfx.X3G_CHANGE_TOOL, 0, 149, 0, 0, 0, 0]) + b'no end'
+        inspector = mfx.X3gInspector()
+        self.assertEqual(inspector.feed(data, len(data)), 2)
+        self.assertEqual(mfx.x3g_command_end(data, 2), -1)
+        self.assertEqual(mfx.x3g_command_end(data + b'\0', 2), len(data) + 1)
+
+    def test_unknown_command(self):
+        data = extended_move(400) + bytes([255]) + extended_move(800)
+        inspector = mfx.X3gInspector()
+        self.assertEqual(inspector.feed(data, len(data)), mfx.MOVE_SIZE)
+        self.assertEqual(inspector.error, f"unknown command 255 at byte {mfx.MOVE_SIZE}")
+        self.assertIsNone(mfx.x3g_command_end(data, mfx.MOVE_SIZE))
+
+    def test_offsets_continue_across_chunks(self):
+        data = extended_move(400) + bytes([255])
+        inspector = mfx.X3gInspector()
+        inspector.feed(data[:10], 10)
+        self.assertEqual(inspector.feed(data, len(data)), mfx.MOVE_SIZE)
+        self.assertEqual(inspector.error, f"unknown command 255 at byte {mfx.MOVE_SIZE}")
+
+
+if __name__ == '__main__':
+    unittest.main()